@@ -1,19 +1,30 @@
-import statistics
+import functools
+import json
+import os
 
-import pandas as pd
 import dash
 from dash_table import DataTable, FormatTemplate
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
-import plotly.express as px
+import numpy as np
 
-index_scores = pd.read_csv(
-    "IndexScores.csv", encoding="unicode_escape", engine="python"
-).groupby()
-index_scores.rename(columns={"INDICATOR_ISSUE": "Issue"}, inplace=True)
-data = pd.read_excel("UNICEF_framework_V09.xlsx", sheet_name="All", skiprows=2)
-data = data.set_index("Reference")
+import cohort
+import exports
+import figures
+import jobs
+import metrics
+import report_cache
+import sessions
+from country_risk import IssueCountryMatrix, load_country_risk
+from framework_registry import FrameworkRegistry
+from scoring import UNANSWERED, ScoringModel, ScoringStates
+from static_layout import FrozenLayout, StaticLayoutDash
+
+country_risk = load_country_risk()
+choropleths = figures.choropleth_traces(country_risk)
+reports = report_cache.from_environment()
+report_jobs = jobs.from_environment()
 
 
 def make_brand(**kwargs):
@@ -142,12 +153,8 @@ def make_question(index, label, question):
             dbc.Label(label, className="mt-2"),
             dbc.RadioItems(
                 options=[
-                    {
-                        "label": option.split("=")[0].strip(),
-                        "value": int(option.split("=")[1].strip()),
-                    }
-                    for option in question["Answer options"].splitlines()
-                    if option
+                    {"label": text, "value": value}
+                    for text, value in question["Answer choices"]
                 ],
                 id={
                     "type": "question-answer",
@@ -159,16 +166,16 @@ def make_question(index, label, question):
     )
 
 
-def make_questions(category, questions):
-    selections = [
+def make_cards(data, rows):
+    return [
         dbc.Card(
             dbc.CardBody(
                 [
                     html.B(
                         [
                             "{}: ".format(question["Question number"]),
-                            question["Question"].splitlines()[0],
-                            *[html.P(q) for q in question["Question"].splitlines()[1:]],
+                            question["Question lines"][0],
+                            *[html.P(q) for q in question["Question lines"][1:]],
                         ]
                     ),
                     html.Div(
@@ -196,20 +203,27 @@ def make_questions(category, questions):
                     ),
                     make_question(index, "Business", question),
                     make_question(index, "Supply Chain", question)
-                    if not pd.isna(question["Supply chain"])
+                    if question["Supply chain"]
                     else None,
                 ]
             ),
             className="m-3",
         )
-        for index, question in questions.iterrows()
+        for index, question in (
+            (data.references[row], data.question(row)) for row in rows
+        )
     ]
+
+
+def make_questions(category):
+    # The cards themselves are sent by render_tab on first activation.
     return dbc.Tab(
         label=category,
+        tab_id=category,
         children=[
             dbc.Form(
-                id=f"{category}-form",
-                children=selections,
+                id={"type": "question-form", "index": category},
+                children=[],
             ),
             html.Div(id={"type": "survey-results", "index": category}),
             dbc.Button(
@@ -222,279 +236,697 @@ def make_questions(category, questions):
     )
 
 
-groups = []
-for category in data["Assessment"].unique():
-    groups.append(make_questions(category, data[data["Assessment"] == category]))
-groups.extend(
-    [
-        dbc.Tab(
-            label="Report",
-            children=[
-                html.Div(
-                    [
-                        html.Br(),
-                        dbc.Button(
-                            "Show Results",
-                            id={"type": "survey-submit", "index": "results"},
-                            color="primary",
-                        ),
-                        html.Div(id={"type": "survey-results", "index": "results"}),
-                    ]
-                )
-            ],
-        ),
-        dbc.Tab(
-            label="Geographic Risk",
-            children=[
-                html.Div(
-                    [
-                        dbc.Card(
-                            dbc.CardBody(
-                                [
-                                    html.B(
-                                        "Answer the following questions to help us identify which countries are relevant to your business, and to your supply chain."
-                                    ),
-                                    html.B(
-                                        "There are 2 questions in total. Please answer each question, answering separately for your business operations, and your supply chain. It  should take 2 minutes to complete this section."
-                                    ),
-                                    html.B(
-                                        "For more information, click on the i button for each question, or click here to learn more about the Children's Rights and Business Atlas xxxxx"
-                                    ),
-                                ]
+def make_export_links(table):
+    # The links' addresses are filled in from the answers by export_links.
+    return html.Div(
+        [
+            "Download as ",
+            html.A("CSV", id={"type": "export-link", "index": f"{table}.csv"}),
+            " or ",
+            html.A("Excel", id={"type": "export-link", "index": f"{table}.xlsx"}),
+        ],
+        className="my-2",
+    )
+
+
+# The tabs after the questions, the same for every version of the framework.
+report_tabs = [
+    dbc.Tab(
+        label="Report",
+        tab_id="results",
+        children=[
+            html.Div(
+                [
+                    html.Br(),
+                    html.Label("Scores so far"),
+                    DataTable(
+                        id="live-scores",
+                        columns=[
+                            dict(id="Issue", name="Issue", type="text"),
+                            dict(id="Score", name="Score (0-4)", type="numeric"),
+                            dict(id="Materiality", name="Materiality", type="text"),
+                            dict(name="Rating", id="combined_rating", type="text"),
+                            dict(name="Priority", id="priority", type="text"),
+                        ],
+                        style_cell={"textAlign": "left"},
+                    ),
+                    html.Br(),
+                    dbc.Button(
+                        "Show Results",
+                        id={"type": "survey-submit", "index": "results"},
+                        color="primary",
+                    ),
+                    make_export_links("scores"),
+                    html.Label(id="peer-count"),
+                    DataTable(
+                        id="peer-scores",
+                        columns=[
+                            dict(id="Issue", name="Issue", type="text"),
+                            dict(id="Score", name="Score (0-4)", type="numeric"),
+                            dict(
+                                id="score_percentile",
+                                name="Percentile",
+                                type="numeric",
                             ),
-                            className="m-3",
-                        ),
-                        dbc.Row(
+                            dict(id="score_median", name="Median", type="numeric"),
+                            dict(
+                                id="priority_score",
+                                name="Priority score",
+                                type="numeric",
+                            ),
+                            dict(
+                                id="priority_percentile",
+                                name="Percentile",
+                                type="numeric",
+                            ),
+                            dict(
+                                id="priority_median",
+                                name="Median",
+                                type="numeric",
+                            ),
+                        ],
+                        style_cell={"textAlign": "left"},
+                    ),
+                    html.Div(id={"type": "survey-results", "index": "results"}),
+                ]
+            )
+        ],
+    ),
+    dbc.Tab(
+        label="Geographic Risk",
+        tab_id="geographic",
+        children=[
+            html.Div(
+                [
+                    dbc.Card(
+                        dbc.CardBody(
                             [
-                                dbc.Col(
-                                    html.B(
-                                        "25d: Please select any countries where your business operates"
-                                    )
+                                html.B(
+                                    "Answer the following questions to help us identify which countries are relevant to your business, and to your supply chain."
                                 ),
-                                dbc.Col(
-                                    dcc.Dropdown(
-                                        options=[
-                                            {"label": country, "value": country}
-                                            for country in index_scores.COUNTRY_ISO_3.unique()
-                                        ],
-                                        multi=True,
-                                        style={
-                                            "zIndex": "auto",
-                                        },
-                                        id="business-countries",
-                                    )
+                                html.B(
+                                    "There are 2 questions in total. Please answer each question, answering separately for your business operations, and your supply chain. It  should take 2 minutes to complete this section."
+                                ),
+                                html.B(
+                                    "For more information, click on the i button for each question, or click here to learn more about the Children's Rights and Business Atlas xxxxx"
                                 ),
                             ]
                         ),
-                        html.Br(),
-                        dbc.Row(
+                        className="m-3",
+                    ),
+                    dbc.Row(
+                        [
+                            dbc.Col(
+                                html.B(
+                                    "25d: Please select any countries where your business operates"
+                                )
+                            ),
+                            dbc.Col(
+                                dcc.Dropdown(
+                                    options=[
+                                        {"label": country, "value": country}
+                                        for country in country_risk.countries
+                                    ],
+                                    multi=True,
+                                    style={
+                                        "zIndex": "auto",
+                                    },
+                                    id="business-countries",
+                                )
+                            ),
+                        ]
+                    ),
+                    html.Br(),
+                    dbc.Row(
+                        [
+                            dbc.Col(
+                                html.B(
+                                    "26d: Please select any countries from where you source goods and services through your supply chain"
+                                )
+                            ),
+                            dbc.Col(
+                                dcc.Dropdown(
+                                    options=[
+                                        {"label": country, "value": country}
+                                        for country in country_risk.countries
+                                    ],
+                                    multi=True,
+                                    style={
+                                        "zIndex": "auto",
+                                    },
+                                    id="supply-countries",
+                                )
+                            ),
+                        ]
+                    ),
+                    html.Br(),
+                    dbc.Row(
+                        [
+                            dbc.Col(html.B("Show country risk for")),
+                            dbc.Col(
+                                dcc.Dropdown(
+                                    options=[
+                                        {"label": issue, "value": issue}
+                                        for issue in country_risk.issues
+                                    ],
+                                    value=country_risk.issues[0],
+                                    clearable=False,
+                                    id="map-issue",
+                                )
+                            ),
+                        ]
+                    ),
+                    dcc.Graph(id="map"),
+                    dbc.Button(
+                        "Show Risks",
+                        id={"type": "survey-submit", "index": "geographic"},
+                        color="primary",
+                    ),
+                    make_export_links("geographic"),
+                    html.Div(id={"type": "survey-results", "index": "geographic"}),
+                ],
+            )
+        ],
+    ),
+]
+
+from dash.dependencies import Input, Output, State, ALL, MATCH
+from dash.exceptions import PreventUpdate
+
+external_stylesheets = [
+    "https://seotest.buzz/dash/assets/styles/main.css",
+    "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0-beta2/css/all.min.css",
+]
+app = StaticLayoutDash(__name__, external_stylesheets=external_stylesheets)
+
+
+def make_layout(data, model):
+    groups = [make_questions(category) for category in data.assessments]
+    groups.extend(report_tabs)
+    return html.Div(
+        [
+            make_header(),
+            html.Br(),
+            dbc.Container(
+                fluid=True,
+                children=[
+                    dbc.Row(
+                        dbc.Col(
                             [
-                                dbc.Col(
-                                    html.B(
-                                        "26d: Please select any countries from where you source goods and services through your supply chain"
-                                    )
-                                ),
-                                dbc.Col(
-                                    dcc.Dropdown(
-                                        options=[
-                                            {"label": country, "value": country}
-                                            for country in index_scores.COUNTRY_ISO_3.unique()
-                                        ],
-                                        multi=True,
-                                        style={
-                                            "zIndex": "auto",
-                                        },
-                                        id="supply-countries",
-                                    )
+                                dbc.Tabs(
+                                    groups,
+                                    id="assessment-tabs",
+                                    active_tab=groups[0].tab_id,
                                 ),
                             ]
                         ),
-                        html.Br(),
-                        dbc.Button(
-                            "Show Risks",
-                            id={"type": "survey-submit", "index": "geographic"},
-                            color="primary",
-                        ),
-                        html.Div(id={"type": "survey-results", "index": "geographic"}),
-                    ],
-                )
-            ],
-        ),
+                    ),
+                ],
+            ),
+            dcc.Store(id="rendered-tabs", data=[]),
+            # Identifies the browser's answers in the session store across reloads.
+            dcc.Store(id="session", storage_type="local"),
+            # The framework version the page was built from; callbacks use the
+            # same version even after a newer one is swapped in.
+            dcc.Store(id="framework-version", data=data.digest),
+            # Answers as one integer per slot, in the scoring model's slot order.
+            dcc.Store(id="answer-slots", data=model.ids),
+            dcc.Store(id="answers", data=[UNANSWERED] * len(model.ids)),
+            # The slots changed by the latest answer, numbered per page load.
+            dcc.Store(id="answer-delta"),
+        ],
+        id="mainContainer",
+    )
+
+
+class Survey:
+    """Everything the app builds from one version of the framework workbook."""
+
+    def __init__(self, data):
+        self.data = data
+        self.digest = data.digest
+        self.scoring_model = ScoringModel(data)
+        self.scoring_states = ScoringStates(
+            self.scoring_model, maxsize=int(os.environ.get("SCORING_STATES", 1024))
+        )
+        self.session_store = sessions.from_environment(self.scoring_model.ids)
+        self.peers = cohort.from_environment(self.scoring_model)
+        self.issue_risk = IssueCountryMatrix(
+            country_risk, self.scoring_model.combined_issues
+        )
+        self.categories = [str(category) for category in data.assessments]
+        # Built on a tab's first render, so a worker only decodes the question
+        # text of tabs its respondents open.
+        self.question_cards = {}
+        self.layout = make_layout(data, self.scoring_model)
+        self.frozen_layout = FrozenLayout(self.layout, version=data.digest)
+
+    def answers(self, session, delta=None):
+        """The session's saved answers, with the latest changes applied.
+
+        The latest delta may still be on its way to update_live_scores, which
+        the browser calls at the same time, so it is applied here as well.
+        """
+        changes = self.changes(delta)
+        encoded = self.session_store.answers(session)
+        for slot, value in changes:
+            encoded[slot] = value
+        return encoded
+
+    def changes(self, delta):
+        """The (slot, value) pairs of a delta from the browser, checked.
+
+        A malformed delta raises PreventUpdate: it comes from the request, and
+        an unchecked slot or value would end up in the saved answers.
+        """
+        if delta is None:
+            return []
+        try:
+            return self.scoring_model.checked_changes(delta["changes"])
+        except (TypeError, KeyError, ValueError):
+            raise PreventUpdate
+
+    def carry_over(self, slots, delta):
+        """A delta made on another version's page, in this version's slots.
+
+        slots are the other version's question ids. Answers to questions this
+        version no longer asks are dropped.
+        """
+        index = self.scoring_model.slot_index
+        try:
+            ids = dict(enumerate(slots))
+            moved = [(ids[slot], value) for slot, value in delta["changes"]]
+            return self.scoring_model.checked_changes(
+                [(index[id], value) for id, value in moved if id in index]
+            )
+        except (TypeError, KeyError, ValueError):
+            raise PreventUpdate
+
+    def cards(self, category):
+        """A tab's question cards as plain JSON, built on first use.
+
+        Plain JSON lets render_tab fill in saved answers per request.
+        """
+        cards = self.question_cards.get(category)
+        if cards is None:
+            cards = json.loads(
+                report_cache.to_json(make_cards(self.data, self.data.rows(category)))
+            )
+            # Two requests may build the same tab at once; keep the first.
+            cards = self.question_cards.setdefault(category, cards)
+        return cards
+
+    def prefill(self, component, encoded):
+        """A copy of serialised cards with the saved answers selected."""
+        if isinstance(component, list):
+            return [self.prefill(child, encoded) for child in component]
+        if not isinstance(component, dict) or "props" not in component:
+            return component
+        props = dict(component["props"])
+        if "children" in props:
+            props["children"] = self.prefill(props["children"], encoded)
+        id = props.get("id")
+        if isinstance(id, dict) and id.get("type") == "question-answer":
+            value = encoded[self.scoring_model.slot_index[id["id"]]]
+            if value != UNANSWERED:
+                props["value"] = int(value)
+        return dict(component, props=props)
+
+
+def use_layout(survey):
+    app.layout = survey.layout
+    app.frozen_layout = survey.frozen_layout
+
+
+surveys = FrameworkRegistry(
+    Survey,
+    interval=float(os.environ.get("FRAMEWORK_POLL_INTERVAL", 5)),
+    on_swap=use_layout,
+)
+metrics.instrument(app, reports)
+metrics.REGISTRY.gauge(
+    "assessment_framework_reloads_total",
+    "Framework workbook reloads by result.",
+    lambda: {(("result", result),): count for result, count in surveys.reloads.items()},
+    type="counter",
+)
+exports.register(app, surveys)
+
+
+def page_survey(version):
+    """The framework version a page was built from, if it can still be had."""
+    survey = surveys.get(version)
+    if survey is None:
+        raise PreventUpdate
+    return survey
+
+
+# Runs in the browser: a new browser gets a random session id, kept in
+# local storage so a reload finds its answers again.
+app.clientside_callback(
+    """
+    function ensure_session(timestamp, session) {
+        if (session) {
+            return window.dash_clientside.no_update;
+        }
+        var bytes = new Uint8Array(16);
+        window.crypto.getRandomValues(bytes);
+        return Array.from(bytes, function (byte) {
+            return ("0" + byte.toString(16)).slice(-2);
+        }).join("");
+    }
+    """,
+    Output("session", "data"),
+    Input("session", "modified_timestamp"),
+    State("session", "data"),
+)
+
+
+@app.callback(
+    Output({"type": "question-form", "index": ALL}, "children"),
+    Output("rendered-tabs", "data"),
+    Input("assessment-tabs", "active_tab"),
+    State("rendered-tabs", "data"),
+    State("session", "data"),
+    State("framework-version", "data"),
+)
+def render_tab(active_tab, rendered, session, version):
+    survey = page_survey(version)
+    # Cards are only sent once per tab, so answers survive switching tabs.
+    if active_tab not in survey.categories or active_tab in rendered:
+        raise PreventUpdate
+    cards = survey.cards(active_tab)
+    if sessions.valid_session(session):
+        encoded = survey.session_store.answers(session)
+        if (encoded != UNANSWERED).any():
+            cards = survey.prefill(cards, encoded)
+    forms = [
+        cards if output["id"]["index"] == active_tab else dash.no_update
+        for output in dash.callback_context.outputs_list[0]
     ]
+    return forms, rendered + [active_tab]
+
+
+# Runs in the browser: flipping a collapse needs no round-trip to a worker.
+app.clientside_callback(
+    """
+    function toggle_collapse(n, is_open) {
+        if (n) {
+            return !is_open;
+        }
+        return is_open;
+    }
+    """,
+    Output({"type": "question-info-content", "index": MATCH}, "is_open"),
+    [Input({"type": "question-info", "index": MATCH}, "n_clicks")],
+    [State({"type": "question-info-content", "index": MATCH}, "is_open")],
 )
 
-meterial = (
-    lambda x: "Low Risk"
-    if x >= 4
-    else ("Medium Risk" if x >= 2 and x < 4 else "High Risk")
+
+# Keeps a copy of the answer vector in the browser, to find which answers
+# changed. Only the changes are sent on, as a numbered delta, which
+# update_live_scores saves to the session store and applies to the scores.
+app.clientside_callback(
+    """
+    function encode_answers(values, ids, answers, slots, delta) {
+        var updated = answers.slice();
+        var changes = [];
+        ids.forEach(function (id, i) {
+            var position = slots.indexOf(id.id);
+            var value = values[i] == null ? %d : values[i];
+            if (position >= 0 && updated[position] !== value) {
+                updated[position] = value;
+                changes.push([position, value]);
+            }
+        });
+        if (!changes.length) {
+            var no_update = window.dash_clientside.no_update;
+            return [no_update, no_update];
+        }
+        return [
+            updated,
+            {
+                version: delta ? delta.version + 1 : 1,
+                changes: changes,
+            },
+        ];
+    }
+    """
+    % UNANSWERED,
+    Output("answers", "data"),
+    Output("answer-delta", "data"),
+    Input({"type": "question-answer", "id": ALL}, "value"),
+    State({"type": "question-answer", "id": ALL}, "id"),
+    State("answers", "data"),
+    State("answer-slots", "data"),
+    State("answer-delta", "data"),
+    prevent_initial_call=True,
 )
 
-rating = (
-    lambda x: "Strong"
-    if x >= 3
-    else ("Good" if x >= 2 and x < 3 else ("Moderate" if x >= 1 and x < 2 else "Weak"))
+
+@app.callback(
+    Output("live-scores", "data"),
+    Input("answer-delta", "data"),
+    State("session", "data"),
+    State("framework-version", "data"),
+    State("answer-slots", "data"),
+    prevent_initial_call=True,
 )
+def update_live_scores(delta, session, version, slots):
+    if not sessions.valid_session(session):
+        raise PreventUpdate
+    survey = surveys.get(version)
+    if survey is None:
+        # The page's version is gone for good (its snapshot too). Save the
+        # answers against the current version by question id rather than
+        # lose them; the page picks the new version up when reloaded.
+        survey = surveys.current
+        changes = survey.carry_over(slots, delta)
+    else:
+        changes = survey.changes(delta)
+    encoded = survey.session_store.apply(session, changes)
+    state = survey.scoring_states.update(session, encoded)
+    return state.combined_rows()
 
-priority = (
-    lambda x: "Not a priority"
-    if x >= 3
-    else (
-        "Low priority"
-        if x >= 2 and x < 3
-        else ("Priority" if x >= 1 and x < 2 else "High priority")
-    )
+
+app.clientside_callback(
+    """
+    function export_links(session, business, supply, ids) {
+        var query = "?session=" + (session || "") +
+            "&business=" + (business || []).join(",") +
+            "&supply=" + (supply || []).join(",");
+        return ids.map(function (id) {
+            return "%sexport/" + id.index + query;
+        });
+    }
+    """
+    % app.config.requests_pathname_prefix,
+    Output({"type": "export-link", "index": ALL}, "href"),
+    Input("session", "data"),
+    Input("business-countries", "value"),
+    Input("supply-countries", "value"),
+    State({"type": "export-link", "index": ALL}, "id"),
 )
 
-from dash.dependencies import Input, Output, State, ALL, MATCH
 
-external_stylesheets = [
-    "https://seotest.buzz/dash/assets/styles/main.css",
-    "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0-beta2/css/all.min.css",
-]
-app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
-
-app.layout = html.Div(
-    [
-        make_header(),
-        html.Br(),
-        dbc.Container(
-            fluid=True,
-            children=[
-                dbc.Row(
-                    dbc.Col(
-                        [
-                            dbc.Tabs(groups),
-                        ]
-                    ),
-                ),
-            ],
-        ),
-    ],
-    id="mainContainer",
+@functools.lru_cache(maxsize=1024)
+def map_figure(issue, countries):
+    return figures.choropleth_figure(choropleths[issue], countries)
+
+
+@app.callback(
+    Output("map", "figure"),
+    Input("map-issue", "value"),
+    Input("business-countries", "value"),
+    Input("supply-countries", "value"),
 )
+def update_map(issue, business_countries, supply_countries):
+    # The issue comes from the request; keep the current map for any other.
+    if not isinstance(issue, str) or issue not in choropleths:
+        raise PreventUpdate
+    countries = sorted({*(business_countries or []), *(supply_countries or [])})
+    return map_figure(issue, tuple(countries))
+
+
+def _round(value):
+    return None if value != value else round(float(value), 1)
 
 
 @app.callback(
-    Output({"type": "question-info-content", "index": MATCH}, "is_open"),
-    [Input({"type": "question-info", "index": MATCH}, "n_clicks")],
-    [State({"type": "question-info-content", "index": MATCH}, "is_open")],
+    Output("peer-scores", "data"),
+    Output("peer-count", "children"),
+    Input({"type": "survey-submit", "index": "results"}, "n_clicks"),
+    State("session", "data"),
+    State("answer-delta", "data"),
+    State("framework-version", "data"),
+    prevent_initial_call=True,
 )
-def toggle_collapse(n, is_open):
-    if n:
-        return not is_open
-    return is_open
+def update_peer_scores(click, session, delta, version):
+    # Showing results counts the respondent in the cohort, replacing their
+    # earlier results, then places their combined scores within it.
+    survey = page_survey(version)
+    if not sessions.valid_session(session):
+        raise PreventUpdate
+    timer = metrics.Timer("update_peer_scores")
+    scoring_model, peers = survey.scoring_model, survey.peers
+    encoded = survey.answers(session, delta)
+    values = cohort.row_values(scoring_model, scoring_model.decode_answers(encoded))[0]
+    if (encoded != UNANSWERED).any():
+        peers.record(session, values)
+    timer.lap("record")
+
+    percentiles = peers.percentiles(values)
+    medians = peers.quantiles(0.5)
+    score, priority = map(cohort.METRICS.index, ["Score", "priority_score"])
+    combined = range(len(scoring_model.row_issue), len(peers.keys))
+    rows = [
+        {
+            "Issue": peers.keys[row][1],
+            "Score": _round(values[score, row]),
+            "score_percentile": _round(percentiles[score, row]),
+            "score_median": _round(medians[score, row]),
+            "priority_score": _round(values[priority, row]),
+            "priority_percentile": _round(percentiles[priority, row]),
+            "priority_median": _round(medians[priority, row]),
+        }
+        for row in combined
+    ]
+    timer.lap("lookup")
+    respondents = int(peers.sizes()[score, combined].max(initial=0))
+    return rows, f"Compared with {respondents} respondents"
+
+
+# The score frames each report is built from.
+REPORT_FRAMES = {
+    "results": ["business_meteriality", "supply_meteriality", "combined_meteriality"],
+    "Materiality": [
+        "business_meteriality",
+        "supply_meteriality",
+        "combined_meteriality",
+    ],
+    "Due diligence": ["due_diligence"],
+    "Mitigation": ["mitigation"],
+    "geographic": ["meteriality_combined"],
+}
+
+# Reports slow enough to build as background jobs rather than in the request.
+BACKGROUND_REPORTS = {"results", "geographic"}
+# How long a request waits for its job before showing progress instead. Most
+# reports are built well within it, and need no polling at all.
+REPORT_JOB_WAIT = float(os.environ.get("REPORT_JOB_WAIT", 0.2))
 
 
 @app.callback(
     Output({"type": "survey-results", "index": MATCH}, "children"),
     Input({"type": "survey-submit", "index": MATCH}, "n_clicks"),
-    State({"type": "question-answer", "id": ALL}, "id"),
-    State({"type": "question-answer", "id": ALL}, "value"),
+    State("session", "data"),
+    State("answer-delta", "data"),
+    State("framework-version", "data"),
     State("business-countries", "value"),
     State("supply-countries", "value"),
     prevent_initial_call=True,
 )
-def display_dropdowns(click, id, value, business_countries, supply_countries):
+def display_dropdowns(
+    click, session, delta, version, business_countries, supply_countries
+):
 
+    survey = page_survey(version)
+    if not sessions.valid_session(session):
+        raise PreventUpdate
     button_id = dash.callback_context.inputs_list[0]["id"]["index"]
-    print(button_id)
-
-    ids = [item["id"] for item in id]
-    values = [item if item else 0 for item in value]
-    results = dict(zip(ids, values))
-    table = pd.DataFrame.from_dict(results, orient="index", columns=["Score"])
-    table.index = table.index.str.split("-", 1, expand=True)
-    table.index.names = ["Reference", "Scope"]
-    table.reset_index(inplace=True)
-    table = table.astype({"Reference": int, "Score": int})
-    table = table.join(data[["Assessment", "Issue"]], on="Reference")
-    table.dropna(inplace=True, subset=["Scope"])
-
-    tables = [html.Br()]
-
-    results = (
-        table.groupby(["Issue", "Scope", "Assessment"])
-        .agg({"Score": "sum"})  # sum of the answers instead
-        .reset_index()
-        .set_index(["Issue"])
+    # The index comes from the request, so only known reports get their own
+    # metrics series.
+    timer = metrics.Timer(
+        "display_dropdowns",
+        button_id=button_id if button_id in REPORT_FRAMES else "other",
     )
 
-    meteriality = results[results["Assessment"] == "Materiality"]
-    due_diligence = results[results["Assessment"] == "Due diligence"]
-    mitigation = results[results["Assessment"] == "Mitigation"]
+    answers = survey.scoring_model.decode_answers(survey.answers(session, delta))
+    timer.lap("answers")
+    # Only the geographic report depends on the selected countries.
+    countries = (
+        [business_countries, supply_countries] if button_id == "geographic" else []
+    )
+    key = reports.key(answers, button_id, countries, namespace=survey.digest)
+    cached = reports.get(key)
+    timer.lap("cache")
+    if cached is not None:
+        return cached
 
-    meteriality["Materiality"] = meteriality["Score"].apply(meterial)
-    due_diligence["Rating"] = due_diligence["Score"].apply(rating)
-    mitigation["Rating"] = mitigation["Score"].apply(rating)
+    if button_id in BACKGROUND_REPORTS:
+        report_jobs.submit(
+            key,
+            build_report_job,
+            survey,
+            key,
+            button_id,
+            answers,
+            business_countries,
+            supply_countries,
+            subscriber=session,
+        )
+        status = report_jobs.wait(key, REPORT_JOB_WAIT, subscriber=session)
+        if status is not None and status["state"] == jobs.DONE:
+            return json.loads(status["result"])
+        return report_progress(button_id, key)
 
-    due_diligence_average = due_diligence["Score"].mean()
-    mitigation["combined_score"] = mitigation["Score"].apply(
-        lambda x: statistics.mean([x, due_diligence_average])
+    return build_report(
+        survey, key, button_id, answers, business_countries, supply_countries, timer
     )
 
-    meteriality_combined = meteriality.join(
-        mitigation, on="Issue", how="outer", rsuffix="mitigation"
-    ).reset_index()
-    meteriality_combined["combined_rating"] = meteriality_combined[
-        "combined_score"
-    ].apply(rating)
-    meteriality_combined["priority_score"] = meteriality_combined[
-        ["Score", "combined_score"]
-    ].mean(axis=1)
-    meteriality_combined["priority"] = meteriality_combined["priority_score"].apply(
-        priority
-    )
 
-    business_meteriality = meteriality_combined[
-        meteriality_combined["Scope"] == "Business"
-    ]
-    supply_meteriality = meteriality_combined[
-        meteriality_combined["Scope"] == "Supply Chain"
-    ]
-    combined_meteriality = (
-        pd.concat([business_meteriality, supply_meteriality])
-        .groupby(["Issue"])
-        .agg({"Score": "mean", "combined_score": "mean", "priority_score": "mean"})
-        .reset_index()
-    )
-    combined_meteriality["Scope"] = "Combined"
-    combined_meteriality["Materiality"] = combined_meteriality["Score"].apply(meterial)
-    combined_meteriality["combined_rating"] = combined_meteriality[
-        "combined_score"
-    ].apply(rating)
-    combined_meteriality["priority"] = combined_meteriality["priority_score"].apply(
-        priority
+def build_report_job(
+    job, survey, key, button_id, answers, business_countries, supply_countries
+):
+    timer = metrics.Timer("display_dropdowns", button_id=button_id)
+    report = build_report(
+        survey,
+        key,
+        button_id,
+        answers,
+        business_countries,
+        supply_countries,
+        timer,
+        job.progress,
     )
+    return report_cache.to_json(report)
+
+
+@metrics.profiled
+def build_report(
+    survey,
+    key,
+    button_id,
+    answers,
+    business_countries,
+    supply_countries,
+    timer,
+    progress=lambda fraction, message="": None,
+):
+
+    scores = survey.scoring_model.score(answers)
+    # Score frames are computed on first use; build them here so their time
+    # is not counted as rendering.
+    for frame in REPORT_FRAMES.get(button_id, []):
+        getattr(scores, frame)
+    timer.lap("scoring")
+    progress(0.3, "Building figures")
+
+    tables = [html.Br()]
 
     if button_id == "results":
 
-        fig = px.scatter(
-            combined_meteriality,
-            x="Score",
-            y="combined_score",
-            text="Issue",
-            labels={
-                "combined_score": "Quality of due diligence",
-                "Score": "Materiality of child rights issues",
-            },
-        )
-        fig.update_layout(yaxis_range=[0, 4], xaxis_range=[0, 4])
-        fig.update_traces(textposition="bottom right")
-        fig.add_hline(y=2)
-        fig.add_vline(x=2)
-
-        bar = px.bar(
-            combined_meteriality,
-            y=["Score", "combined_score"],
-            x="Issue",
-            barmode="group",
-            labels={
-                "combined_score": "Due diligence",
-                "Score": "Materiality",
-            },
-            title="Due diligence of material issues",
+        combined_meteriality = scores.combined_meteriality
+
+        issue_scores = (
+            combined_meteriality["Issue"],
+            combined_meteriality["Score"],
+            combined_meteriality["combined_score"],
         )
-        fig.update_layout(yaxis_range=[0, 4])
+        fig = figures.matrix_figure(*issue_scores)
+        bar = figures.bar_figure(*issue_scores)
+        timer.lap("figures")
+        progress(0.6, "Building tables")
 
         tables.extend([dcc.Graph(figure=bar), dcc.Graph(figure=fig)])
         tables.extend(
@@ -561,8 +993,8 @@ def display_dropdowns(click, id, value, business_countries, supply_countries):
                     ]
                 )
                 for scope in [
-                    business_meteriality,
-                    supply_meteriality,
+                    scores.business_meteriality,
+                    scores.supply_meteriality,
                     combined_meteriality,
                 ]
             ]
@@ -614,15 +1046,17 @@ def display_dropdowns(click, id, value, business_countries, supply_countries):
                     ]
                 )
                 for scope in [
-                    business_meteriality,
-                    supply_meteriality,
-                    combined_meteriality,
+                    scores.business_meteriality,
+                    scores.supply_meteriality,
+                    scores.combined_meteriality,
                 ]
             ]
         )
     elif button_id == "Due diligence" or button_id == "Mitigation":
 
-        results_frame = due_diligence if button_id == "Due diligence" else mitigation
+        results_frame = (
+            scores.due_diligence if button_id == "Due diligence" else scores.mitigation
+        )
 
         tables.extend(
             [
@@ -666,92 +1100,204 @@ def display_dropdowns(click, id, value, business_countries, supply_countries):
 
     elif button_id == "geographic":
 
-        index_data = index_scores[
-            index_scores["COUNTRY_ISO_3"].isin(
-                set().union(business_countries, supply_countries)
-            )
-        ]
-        buisness = meteriality_combined[
-            meteriality_combined["priority_score"]
-            < 2 & meteriality_combined["Scope"]
-            == "Business"
-        ]
-        supply = meteriality_combined[
-            meteriality_combined["priority_score"]
-            < 2 & meteriality_combined["Scope"]
-            == "Supply"
-        ]
-        geo_business = buisness.join(
-            index_scores[index_scores["COUNTRY_ISO_3"].isin(business_countries)],
-            on="Issue",
-            how="outer",
-            rsuffix="geo",
-        ).reset_index()
+        meteriality_combined = scores.meteriality_combined
+        issue_risk = survey.issue_risk
+        selected = {
+            "Business": issue_risk.mask(business_countries),
+            "Supply Chain": issue_risk.mask(supply_countries),
+        }
+        # Each scope's priority issues weigh equally in its countries' risk.
+        priorities = {
+            scope: meteriality_combined[
+                (meteriality_combined["Scope"] == scope)
+                & (meteriality_combined["priority_score"] < 2)
+            ]
+            for scope in selected
+        }
+        weights = np.zeros((len(selected), len(issue_risk.issues)))
+        for row, scope in enumerate(selected):
+            for issue in priorities[scope]["Issue"]:
+                weights[row, issue_risk.issue_index[issue]] = 1
+        union = selected["Business"] | selected["Supply Chain"]
+        risk = issue_risk.combined(weights, union)
+        timer.lap("risk")
+        progress(0.6, "Ranking countries")
 
-        tables.extend(
-            [
-                dcc.Graph(
-                    id="map",
-                    figure=px.choropleth(
-                        index_scores,  # pandas dataframe to use
-                        locations="COUNTRY_ISO_3",  # column in df with ISO-3 code
-                        color="ISSUE_INDEX_SCORE",  # column in df with values we want to show
-                        hover_name="INDICATOR_ISSUE",  # column in df to add to hover
-                        color_continuous_scale=px.colors.sequential.Plasma,
-                    ),
-                ),
-                DataTable(
-                    data=geo_output.sort_values("Score").to_dict("records"),
-                    columns=[
-                        dict(id="Scope", name="Scope", type="text"),
-                        dict(id="Issue", name="Issue", type="text"),
-                        dict(
-                            name="Score (0-3)",
-                            id="priority_score",
-                            type="numeric",
-                        ),
-                        dict(name="Priority", id="priority", type="text"),
-                    ],
-                    style_cell={"textAlign": "left"},
-                    sort_by=[{"column_id": "priority_score", "direction": "asc"}],
-                    style_header_conditional=[
-                        {
-                            "if": {"column_id": "Issue"},
-                            "backgroundColor": "lightBlue",
-                        },
-                        {
-                            "if": {"column_id": "Score"},
-                            "backgroundColor": "lightBlue",
-                        },
-                        {
-                            "if": {"column_id": "Materiality"},
-                            "backgroundColor": "lightBlue",
-                        },
-                        {
-                            "if": {"column_id": "combined_score"},
-                            "backgroundColor": "yellow",
-                        },
-                        {
-                            "if": {"column_id": "combined_rating"},
-                            "backgroundColor": "yellow",
-                        },
-                        {
-                            "if": {"column_id": "priority_score"},
-                            "backgroundColor": "green",
-                            "color": "white",
-                        },
-                        {
-                            "if": {"column_id": "priority"},
-                            "backgroundColor": "green",
-                            "color": "white",
-                        },
-                    ],
+        for row, (scope, mask) in enumerate(selected.items()):
+            if not mask.any():
+                tables.append(html.P(f"Scope: {scope}: no countries selected."))
+                continue
+            country_risk_rows = sorted(
+                (
+                    {"COUNTRY_ISO_3": country, "risk_score": round(float(score), 3)}
+                    for country, score in zip(
+                        issue_risk.countries[mask], risk[row, mask[union]]
+                    )
+                    if score == score
                 ),
+                key=lambda country: -country["risk_score"],
+            )
+            issue_priority = priorities[scope].set_index("Issue")
+            issue_rows = [
+                {
+                    "Issue": issue,
+                    "priority_score": issue_priority.at[issue, "priority_score"],
+                    "priority": issue_priority.at[issue, "priority"],
+                    "COUNTRY_ISO_3": country,
+                    "ISSUE_INDEX_SCORE": round(float(score), 3),
+                    "TIME_PERIOD": int(period),
+                    "rank": rank,
+                }
+                for issue, country, score, period, rank in issue_risk.ranked(
+                    issue_priority.index, mask
+                )
             ]
-        )
+            tables.append(
+                html.Div(
+                    [
+                        html.Label(f"Scope: {scope}"),
+                        DataTable(
+                            data=country_risk_rows,
+                            columns=[
+                                dict(id="COUNTRY_ISO_3", name="Country", type="text"),
+                                dict(
+                                    id="risk_score",
+                                    name="Risk of priority issues",
+                                    type="numeric",
+                                ),
+                            ],
+                            style_cell={"textAlign": "left"},
+                            page_size=20,
+                        ),
+                        html.Br(),
+                        DataTable(
+                            data=issue_rows,
+                            columns=[
+                                dict(id="Issue", name="Issue", type="text"),
+                                dict(
+                                    name="Score (0-3)",
+                                    id="priority_score",
+                                    type="numeric",
+                                ),
+                                dict(name="Priority", id="priority", type="text"),
+                                dict(id="COUNTRY_ISO_3", name="Country", type="text"),
+                                dict(
+                                    id="ISSUE_INDEX_SCORE",
+                                    name="Index score",
+                                    type="numeric",
+                                ),
+                                dict(id="TIME_PERIOD", name="Year", type="numeric"),
+                                dict(id="rank", name="Rank", type="numeric"),
+                            ],
+                            style_cell={"textAlign": "left"},
+                            page_size=20,
+                            style_header_conditional=[
+                                {
+                                    "if": {"column_id": "Issue"},
+                                    "backgroundColor": "lightBlue",
+                                },
+                                {
+                                    "if": {"column_id": "priority_score"},
+                                    "backgroundColor": "green",
+                                    "color": "white",
+                                },
+                                {
+                                    "if": {"column_id": "priority"},
+                                    "backgroundColor": "green",
+                                    "color": "white",
+                                },
+                            ],
+                        ),
+                    ]
+                )
+            )
 
+    timer.lap("components")
+    progress(0.9, "Preparing report")
+    tables = reports.set(key, tables)
+    timer.lap("serialise")
     return tables
 
 
+def report_progress(button_id, key):
+    """Stands in for a report while it is built in the background."""
+    return html.Div(
+        [
+            html.Div(
+                id={"type": "report-job-status", "index": button_id},
+                children=[
+                    html.Br(),
+                    dbc.Progress(
+                        "Queued",
+                        id={"type": "report-progress", "index": button_id},
+                        value=0,
+                        striped=True,
+                        animated=True,
+                    ),
+                    dbc.Button(
+                        "Cancel",
+                        id={"type": "report-cancel", "index": button_id},
+                        color="link",
+                        size="sm",
+                    ),
+                ],
+            ),
+            dcc.Interval(id={"type": "report-poll", "index": button_id}, interval=500),
+            dcc.Store(id={"type": "report-job", "index": button_id}, data=key),
+            html.Div(id={"type": "report-job-output", "index": button_id}),
+        ]
+    )
+
+
+@app.callback(
+    Output({"type": "report-job-output", "index": MATCH}, "children"),
+    Output({"type": "report-progress", "index": MATCH}, "value"),
+    Output({"type": "report-progress", "index": MATCH}, "children"),
+    Output({"type": "report-job-status", "index": MATCH}, "style"),
+    Output({"type": "report-poll", "index": MATCH}, "disabled"),
+    Input({"type": "report-poll", "index": MATCH}, "n_intervals"),
+    State({"type": "report-job", "index": MATCH}, "data"),
+    State("session", "data"),
+)
+def poll_report(n_intervals, key, session):
+    status = report_jobs.status(key, subscriber=session)
+    if status is not None and status["state"] in (jobs.QUEUED, jobs.RUNNING):
+        return (
+            dash.no_update,
+            round(100 * status["progress"]),
+            status["message"] or "Queued",
+            dash.no_update,
+            False,
+        )
+
+    if status is None:
+        report = html.P("The report expired, please submit again.")
+    elif status["state"] == jobs.DONE:
+        report = json.loads(status["result"])
+    elif status["state"] == jobs.CANCELLED:
+        report = html.P("Report cancelled.")
+    else:
+        report = html.P("The report could not be built, please try again.")
+    return report, 100, "", {"display": "none"}, True
+
+
+@app.callback(
+    Output({"type": "report-cancel", "index": MATCH}, "disabled"),
+    Input({"type": "report-cancel", "index": MATCH}, "n_clicks"),
+    State({"type": "report-job", "index": MATCH}, "data"),
+    State("session", "data"),
+    prevent_initial_call=True,
+)
+def cancel_report(n_clicks, key, session):
+    # Other respondents with the same answers may be waiting for the same job.
+    report_jobs.cancel(key, subscriber=session)
+    return True
+
+
 if __name__ == "__main__":
-    app.run_server(debug=True, host="0.0.0.0")
+    # The development server. Production serves wsgi:server with gunicorn.
+    app.run_server(
+        debug=os.environ.get("DASH_DEBUG", "").lower() in ("1", "true"),
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", 8050)),
+    )
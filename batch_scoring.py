@@ -0,0 +1,263 @@
+"""Score many completed assessments at once.
+
+Input is a CSV or Parquet file with one row per respondent and one column per
+answer slot, named like the survey's answer ids ("{Reference}-{Scope}", e.g.
+"1-Business" or "1-Supply Chain"). Blank answers score 0, as in the app.
+Output has one row per respondent, scope and issue, with the columns of the
+Report tab tables.
+
+    python batch_scoring.py answers.csv scores.csv --id-column respondent
+"""
+import argparse
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from framework import FRAMEWORK_PATH, load_framework
+from scoring import (
+    MATERIALITY_BINS,
+    PRIORITY_BINS,
+    RATING_BINS,
+    SCOPES,
+    UNANSWERED,
+    ScoringModel,
+    bin_codes,
+)
+
+RESULT_COLUMNS = [
+    "Scope",
+    "Issue",
+    "Score",
+    "Materiality",
+    "combined_score",
+    "combined_rating",
+    "priority_score",
+    "priority",
+]
+
+
+def answer_matrix(model, frame):
+    """Align the answer columns of a frame to the model's slot order."""
+    columns = [column for column in frame.columns if column in model.slot_index]
+    if not columns:
+        raise ValueError("no answer columns named like the survey's answer ids")
+    answers = np.zeros((len(frame), len(model.ids)))
+    values = frame[columns].apply(pd.to_numeric, errors="coerce").to_numpy(float)
+    values[np.isnan(values) | (values == UNANSWERED)] = 0
+    answers[:, [model.slot_index[column] for column in columns]] = values
+    return answers
+
+
+def score_answers(model, frame, id_column=None):
+    """Score every row of an answer frame in one vectorised pass."""
+    respondents = frame[id_column].to_numpy() if id_column else frame.index.to_numpy()
+    arrays = model.reduce(answer_matrix(model, frame))
+
+    # Business rows, then supply chain rows, then the combined scope, as in
+    # the Report tab.
+    scoped = np.concatenate(
+        [np.flatnonzero(model.row_scope == scope) for scope in SCOPES]
+    )
+    rows = {
+        "Scope": model.row_scope[scoped],
+        "Issue": model.row_issue[scoped],
+        "Score": arrays["row_score"][:, scoped],
+        "combined_score": arrays["row_combined"][:, scoped],
+        "priority_score": arrays["row_priority"][:, scoped],
+    }
+    combined = {
+        "Scope": np.full(len(model.combined_issues), "Combined", dtype=object),
+        "Issue": model.combined_issues,
+        **arrays["combined"],
+    }
+
+    # Text columns are categorical: cheap to build, to hold and to send back
+    # from pool workers.
+    per_respondent = len(scoped) + len(model.combined_issues)
+    columns = {"respondent": np.repeat(respondents, per_respondent)}
+    for name in ["Scope", "Issue"]:
+        categories, codes = np.unique(
+            np.concatenate([rows[name], combined[name]]).astype(str),
+            return_inverse=True,
+        )
+        columns[name] = pd.Categorical.from_codes(
+            np.tile(codes, len(respondents)), categories
+        )
+    for name in ["Score", "combined_score", "priority_score"]:
+        columns[name] = np.hstack([rows[name].astype(float), combined[name]]).ravel()
+    for name, score, bins in [
+        ("Materiality", "Score", MATERIALITY_BINS),
+        ("combined_rating", "combined_score", RATING_BINS),
+        ("priority", "priority_score", PRIORITY_BINS),
+    ]:
+        columns[name] = pd.Categorical.from_codes(
+            bin_codes(columns[score], bins), bins[1]
+        )
+
+    return pd.DataFrame(columns)[["respondent", *RESULT_COLUMNS]]
+
+
+def read_chunks(source, chunksize, parquet=None):
+    """Answer frames of up to chunksize rows from a path or binary file."""
+    if parquet is None:
+        parquet = str(source).endswith(".parquet")
+    if parquet:
+        import pyarrow.parquet
+
+        for batch in pyarrow.parquet.ParquetFile(source).iter_batches(chunksize):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(source, chunksize=chunksize)
+
+
+class ResultWriter:
+    def __init__(self, path):
+        self.path = path
+        self.parquet = None
+        self.started = False
+
+    def write(self, results):
+        if self.path.endswith(".parquet"):
+            import pyarrow
+            import pyarrow.parquet
+
+            table = pyarrow.Table.from_pandas(results, preserve_index=False)
+            if self.parquet is None:
+                self.parquet = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+            self.parquet.write_table(table)
+        else:
+            results.to_csv(
+                self.path,
+                mode="a" if self.started else "w",
+                header=not self.started,
+                index=False,
+            )
+        self.started = True
+
+    def close(self):
+        if self.parquet is not None:
+            self.parquet.close()
+
+
+def share_model(model):
+    """Copy the model's numeric arrays into shared memory blocks.
+
+    Returns the blocks, which must stay open (and be unlinked) by the caller,
+    and a small description workers can rebuild the model from without the
+    arrays themselves being pickled.
+    """
+    blocks, arrays, attributes = [], {}, {}
+    for name, value in vars(model).items():
+        if isinstance(value, np.ndarray) and value.dtype != object:
+            block = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+            np.ndarray(value.shape, value.dtype, buffer=block.buf)[...] = value
+            blocks.append(block)
+            arrays[name] = (block.name, value.shape, value.dtype.str)
+        else:
+            attributes[name] = value
+    return blocks, {"arrays": arrays, "attributes": attributes}
+
+
+def attach_model(shared):
+    """Rebuild a ScoringModel whose arrays are read-only views of shared memory."""
+    model = ScoringModel.__new__(ScoringModel)
+    vars(model).update(shared["attributes"])
+    blocks = []
+    for name, (block_name, shape, dtype) in shared["arrays"].items():
+        block = shared_memory.SharedMemory(name=block_name)
+        array = np.ndarray(shape, dtype, buffer=block.buf)
+        array.flags.writeable = False
+        blocks.append(block)
+        setattr(model, name, array)
+    return model, blocks
+
+
+_worker = {}
+
+
+def _start_worker(shared):
+    _worker["model"], _worker["blocks"] = attach_model(shared)
+
+
+def _score_chunk(job):
+    chunk, id_column = job
+    return len(chunk), score_answers(_worker["model"], chunk, id_column)
+
+
+def numbered_chunks(chunks, id_column=None):
+    """Number respondents across chunks when there is no id column."""
+    respondents = 0
+    for chunk in chunks:
+        if id_column is None:
+            chunk.index = pd.RangeIndex(respondents, respondents + len(chunk))
+        respondents += len(chunk)
+        yield chunk
+
+
+def score_file(model, source, destination, id_column=None, chunksize=10000, workers=1):
+    """Stream answers from source to scored rows in destination, chunk by chunk.
+
+    With more than one worker, chunks are scored by a process pool whose
+    workers share the model's arrays, and written in input order, so the
+    output is identical to a single process run.
+    """
+    writer = ResultWriter(destination)
+    respondents = 0
+    chunks = numbered_chunks(read_chunks(source, chunksize), id_column)
+    try:
+        if workers > 1:
+            blocks, shared = share_model(model)
+            try:
+                with multiprocessing.Pool(
+                    workers, initializer=_start_worker, initargs=(shared,)
+                ) as pool:
+                    jobs = ((chunk, id_column) for chunk in chunks)
+                    for scored, results in pool.imap(_score_chunk, jobs):
+                        writer.write(results)
+                        respondents += scored
+            finally:
+                for block in blocks:
+                    block.close()
+                    block.unlink()
+        else:
+            for chunk in chunks:
+                writer.write(score_answers(model, chunk, id_column))
+                respondents += len(chunk)
+    finally:
+        writer.close()
+    return respondents
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score completed assessments in bulk.")
+    parser.add_argument("answers", help="CSV or Parquet file of answer vectors")
+    parser.add_argument("output", help="CSV or Parquet file to write scores to")
+    parser.add_argument(
+        "--id-column", help="column identifying each respondent (default: row number)"
+    )
+    parser.add_argument("--chunksize", type=int, default=10000)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="processes to score with (default: 1, 0 for one per CPU)",
+    )
+    parser.add_argument("--framework", default=FRAMEWORK_PATH)
+    args = parser.parse_args(argv)
+
+    model = ScoringModel(load_framework(args.framework))
+    respondents = score_file(
+        model,
+        args.answers,
+        args.output,
+        args.id_column,
+        args.chunksize,
+        args.workers or multiprocessing.cpu_count(),
+    )
+    print(f"Scored {respondents} respondents into {args.output}")
+
+
+if __name__ == "__main__":
+    main()
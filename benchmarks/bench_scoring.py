@@ -0,0 +1,177 @@
+"""Compare the vectorised scoring engine with the original pandas pipeline.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_scoring
+"""
+import argparse
+import random
+import statistics
+import timeit
+import warnings
+
+import pandas as pd
+
+from framework import load_framework, parse_framework, split_answer_options
+from scoring import ScoringModel
+
+FRAMES = [
+    "due_diligence",
+    "mitigation",
+    "meteriality_combined",
+    "business_meteriality",
+    "supply_meteriality",
+    "combined_meteriality",
+]
+
+meterial = (
+    lambda x: "Low Risk"
+    if x >= 4
+    else ("Medium Risk" if x >= 2 and x < 4 else "High Risk")
+)
+
+rating = (
+    lambda x: "Strong"
+    if x >= 3
+    else ("Good" if x >= 2 and x < 3 else ("Moderate" if x >= 1 and x < 2 else "Weak"))
+)
+
+priority = (
+    lambda x: "Not a priority"
+    if x >= 3
+    else (
+        "Low priority"
+        if x >= 2 and x < 3
+        else ("Priority" if x >= 1 and x < 2 else "High priority")
+    )
+)
+
+
+def legacy_scores(data, ids, value):
+    """The per-request pipeline display_dropdowns used before scoring.py."""
+    values = [item if item else 0 for item in value]
+    results = dict(zip(ids, values))
+    table = pd.DataFrame.from_dict(results, orient="index", columns=["Score"])
+    table.index = table.index.str.split("-", 1, expand=True)
+    table.index.names = ["Reference", "Scope"]
+    table.reset_index(inplace=True)
+    table = table.astype({"Reference": int, "Score": int})
+    table = table.join(data[["Assessment", "Issue"]], on="Reference")
+    table.dropna(inplace=True, subset=["Scope"])
+
+    results = (
+        table.groupby(["Issue", "Scope", "Assessment"])
+        .agg({"Score": "sum"})
+        .reset_index()
+        .set_index(["Issue"])
+    )
+
+    meteriality = results[results["Assessment"] == "Materiality"]
+    due_diligence = results[results["Assessment"] == "Due diligence"]
+    mitigation = results[results["Assessment"] == "Mitigation"]
+
+    meteriality["Materiality"] = meteriality["Score"].apply(meterial)
+    due_diligence["Rating"] = due_diligence["Score"].apply(rating)
+    mitigation["Rating"] = mitigation["Score"].apply(rating)
+
+    due_diligence_average = due_diligence["Score"].mean()
+    mitigation["combined_score"] = mitigation["Score"].apply(
+        lambda x: statistics.mean([x, due_diligence_average])
+    )
+
+    meteriality_combined = meteriality.join(
+        mitigation, on="Issue", how="outer", rsuffix="mitigation"
+    ).reset_index()
+    meteriality_combined["combined_rating"] = meteriality_combined[
+        "combined_score"
+    ].apply(rating)
+    meteriality_combined["priority_score"] = meteriality_combined[
+        ["Score", "combined_score"]
+    ].mean(axis=1)
+    meteriality_combined["priority"] = meteriality_combined["priority_score"].apply(
+        priority
+    )
+
+    business_meteriality = meteriality_combined[
+        meteriality_combined["Scope"] == "Business"
+    ]
+    supply_meteriality = meteriality_combined[
+        meteriality_combined["Scope"] == "Supply Chain"
+    ]
+    combined_meteriality = (
+        pd.concat([business_meteriality, supply_meteriality])
+        .groupby(["Issue"])
+        .agg({"Score": "mean", "combined_score": "mean", "priority_score": "mean"})
+        .reset_index()
+    )
+    combined_meteriality["Scope"] = "Combined"
+    combined_meteriality["Materiality"] = combined_meteriality["Score"].apply(meterial)
+    combined_meteriality["combined_rating"] = combined_meteriality[
+        "combined_score"
+    ].apply(rating)
+    combined_meteriality["priority"] = combined_meteriality["priority_score"].apply(
+        priority
+    )
+
+    frames = locals()
+    return {name: frames[name] for name in FRAMES}
+
+
+def random_answers(data, model, rng):
+    """Answer values drawn from each question's own options, some left blank."""
+    choices = {}
+    for reference, question in data.iterrows():
+        choices[reference] = [
+            value for _, value in split_answer_options(question["Answer options"])
+        ]
+    return [rng.choice(choices[int(id.split("-", 1)[0])] + [None]) for id in model.ids]
+
+
+def vectorised_scores(model, ids, value):
+    scores = model.score(model.answer_vector(ids, value))
+    return {name: getattr(scores, name) for name in FRAMES}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vectors", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter("ignore")
+    # The original pipeline joins on the parsed sheet itself.
+    data = parse_framework()
+    model = ScoringModel(load_framework())
+    rng = random.Random(args.seed)
+    vectors = [random_answers(data, model, rng) for _ in range(args.vectors)]
+
+    for value in vectors:
+        expected = legacy_scores(data, model.ids, value)
+        actual = vectorised_scores(model, model.ids, value)
+        for name in FRAMES:
+            pd.testing.assert_frame_equal(actual[name], expected[name])
+    print(f"{len(vectors)} answer vectors score identically")
+
+    timings = {}
+    for label, run in [
+        ("pandas pipeline", lambda v: legacy_scores(data, model.ids, v)),
+        ("vectorised", lambda v: vectorised_scores(model, model.ids, v)),
+    ]:
+        best = min(
+            timeit.repeat(
+                lambda: [run(value) for value in vectors],
+                number=1,
+                repeat=args.repeat,
+            )
+        )
+        timings[label] = best / len(vectors)
+        print(f"{label:>16}: {timings[label] * 1000:8.3f} ms per request")
+    print(
+        f"{'speedup':>16}: "
+        f"{timings['pandas pipeline'] / timings['vectorised']:8.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,562 @@
+"""Replay survey traffic against a running server to find where it saturates.
+
+Each simulated respondent goes through the survey the way the Dash renderer
+drives it. It loads the layout, opens each question tab and answers its
+questions one click at a time, and submits each assessment. It then asks for
+the results, picks countries on the map and asks for the geographic report,
+polling report jobs until they are ready. Answers, tabs, issues and countries
+are drawn from the framework workbook and the country risk scores, as in
+benchmarks.run.
+
+The number of concurrent respondents ramps through --users, holding each
+level for --duration seconds. Every level reports throughput, p50/p95/p99
+latency per callback and, given the gunicorn master's pid, the resident
+memory of its workers. The level where throughput stops growing while
+latency keeps climbing is the saturation point of that configuration.
+
+The respondents are real to the server: their answers are saved in its
+session store and asking for results counts them in its cohort, for good.
+Run the server on a scratch data directory and delete it afterwards:
+
+    export ASSESSMENT_DATA_DIR=$(mktemp -d)
+    gunicorn wsgi:server --pid gunicorn.pid &
+    python -m benchmarks.loadtest --url http://127.0.0.1:8050 \\
+        --pid gunicorn.pid --users 1,2,4,8,16,32 --output load.json
+    kill $(cat gunicorn.pid) && rm -r "$ASSESSMENT_DATA_DIR"
+
+A server on another host is only replayed against with --allow-remote.
+
+Opening a question's details (toggle_collapse) runs in the browser, so those
+clicks make no requests and are not replayed.
+"""
+import argparse
+import gzip
+import http.client
+import json
+import math
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+from benchmarks.run import git_commit
+from benchmarks.traffic import (
+    REPORT_BUTTONS,
+    delta_body,
+    map_body,
+    peer_scores_body,
+    poll_body,
+    random_answers,
+    random_countries,
+    random_session,
+    render_tab_body,
+    report_job,
+    submit_body,
+)
+from country_risk import load_country_risk
+from framework import FRAMEWORK_PATH, load_framework
+from scoring import UNANSWERED, ScoringModel
+
+UPDATE = "/_dash-update-component"
+
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+
+
+class RequestFailed(Exception):
+    pass
+
+
+class Stopped(Exception):
+    pass
+
+
+def percentiles(seconds):
+    milliseconds = sorted(1000 * second for second in seconds)
+
+    def rank(q):
+        return round(milliseconds[math.ceil(q * len(milliseconds)) - 1], 3)
+
+    return {
+        "requests": len(milliseconds),
+        "p50_ms": rank(0.5),
+        "p95_ms": rank(0.95),
+        "p99_ms": rank(0.99),
+        "max_ms": round(milliseconds[-1], 3),
+    }
+
+
+class Recorder:
+    """Latencies of every request made during one level, by callback."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []
+        self.surveys = 0
+
+    def record(self, name, seconds, error=None):
+        with self.lock:
+            self.samples.append((name, seconds, error))
+
+    def finished_survey(self):
+        with self.lock:
+            self.surveys += 1
+
+    def take(self):
+        """Everything recorded so far, starting afresh."""
+        with self.lock:
+            samples, self.samples = self.samples, []
+            surveys, self.surveys = self.surveys, 0
+        return samples, surveys
+
+
+class Client:
+    """One browser's keep-alive connection, timing each request it makes."""
+
+    def __init__(self, url, record, timeout=60):
+        parts = urlsplit(url)
+        self.connection_class = (
+            http.client.HTTPSConnection
+            if parts.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip("/")
+        self.record = record
+        self.timeout = timeout
+        self.connection = None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def _send(self, method, path, body, headers):
+        # The server may have closed an idle connection; like a browser,
+        # try once more on a new one.
+        for attempt in range(2):
+            reused = self.connection is not None
+            if not reused:
+                self.connection = self.connection_class(
+                    self.netloc, timeout=self.timeout
+                )
+            try:
+                self.connection.request(method, self.prefix + path, body, headers)
+                response = self.connection.getresponse()
+                return response, response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError):
+                self.close()
+                if not reused or attempt:
+                    raise
+
+    def request(self, name, method, path, body=None, parse=False):
+        """Make a request timed as name; its JSON if parse (None for a 204)."""
+        headers = {"Accept-Encoding": "gzip"}
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        start = time.perf_counter()
+        try:
+            response, data = self._send(method, path, body, headers)
+        except (OSError, http.client.HTTPException) as error:
+            self.close()
+            self.record(name, time.perf_counter() - start, type(error).__name__)
+            raise RequestFailed(f"{name}: {error!r}") from error
+        seconds = time.perf_counter() - start
+        if response.status not in (200, 204):
+            self.record(name, seconds, f"HTTP {response.status}")
+            raise RequestFailed(f"{name}: HTTP {response.status}")
+        self.record(name, seconds)
+        if not parse or response.status == 204:
+            return None
+        if response.getheader("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+        return json.loads(data)
+
+
+class Plan:
+    """What the traffic is drawn from: the framework and the country scores."""
+
+    def __init__(self, framework_path):
+        self.data = load_framework(framework_path)
+        self.model = ScoringModel(self.data)
+        self.version = self.data.digest
+        self.categories = [str(category) for category in self.data.assessments]
+        assessment = {
+            str(reference): self.data.assessment(row)
+            for row, reference in enumerate(self.data.references)
+        }
+        # The answer slots on each question tab, in slot order.
+        self.positions = defaultdict(list)
+        for position, id in enumerate(self.model.ids):
+            self.positions[assessment[id.split("-", 1)[0]]].append(position)
+        store = load_country_risk()
+        self.issues = list(store.issues)
+        self.countries = list(store.countries)
+
+
+class Respondent:
+    """Goes through the survey as one browser, pausing between clicks."""
+
+    def __init__(self, client, plan, rng, stop, think=0.0):
+        self.client = client
+        self.plan = plan
+        self.rng = rng
+        self.stop = stop
+        self.think = think
+
+    def wait(self, seconds):
+        if self.stop.wait(seconds) if seconds > 0 else self.stop.is_set():
+            raise Stopped
+
+    def pause(self):
+        self.wait(self.rng.expovariate(1 / self.think) if self.think > 0 else 0)
+
+    def get(self, name, path):
+        self.pause()
+        self.client.request(name, "GET", path)
+
+    def post(self, name, body, parse=False):
+        self.pause()
+        return self.client.request(name, "POST", UPDATE, body, parse)
+
+    def report(self, button_id, session, delta, business=None, supply=None):
+        """Submit for a report and poll its job, as the page would, until ready."""
+        start = time.perf_counter()
+        response = self.post(
+            f"display_dropdowns[{button_id}]",
+            submit_body(button_id, session, self.plan.version, business, supply, delta),
+            parse=True,
+        )
+        if response is None:
+            raise RequestFailed(f"no {button_id} report for this framework version")
+        (output,) = response["response"].values()
+        job = report_job(output["children"])
+        n_intervals = 0
+        while job is not None:
+            key, interval = job
+            self.wait(interval)
+            n_intervals += 1
+            response = self.client.request(
+                "poll_report",
+                "POST",
+                UPDATE,
+                poll_body(button_id, key, n_intervals, session),
+                parse=True,
+            )
+            if any(output.get("disabled") for output in response["response"].values()):
+                job = None
+        self.client.record(f"report ready[{button_id}]", time.perf_counter() - start)
+
+    def survey(self):
+        plan, rng = self.plan, self.rng
+        session = random_session(rng)
+        self.get("layout", "/_dash-layout")
+        self.get("dependencies", "/_dash-dependencies")
+
+        answers = random_answers(plan.data, plan.model, rng)
+        rendered, delta = [], None
+        for category in plan.categories:
+            self.post(
+                "render_tab",
+                render_tab_body(
+                    category, plan.categories, plan.version, rendered, session
+                ),
+            )
+            rendered.append(category)
+            # One click per answered question, each sent on as its own delta.
+            for position in plan.positions[category]:
+                if answers[position] == UNANSWERED:
+                    continue
+                delta = {
+                    "version": (delta or {"version": 0})["version"] + 1,
+                    "changes": [[position, answers[position]]],
+                }
+                self.post(
+                    "update_live_scores",
+                    delta_body(
+                        session,
+                        plan.version,
+                        delta["version"],
+                        delta["changes"],
+                        plan.model.ids,
+                    ),
+                )
+            if category in REPORT_BUTTONS:
+                self.report(category, session, delta)
+
+        self.post("update_peer_scores", peer_scores_body(session, plan.version, delta))
+        self.report("results", session, delta)
+
+        business = random_countries(plan.countries, rng)
+        supply = random_countries(plan.countries, rng)
+        self.post("update_map", map_body(rng.choice(plan.issues), business, supply))
+        self.report("geographic", session, delta, business, supply)
+
+
+class WorkerMemory:
+    """Samples the resident memory of a server's workers in the background.
+
+    pid is the gunicorn master, whose children are sampled; a server without
+    children (the development server) is sampled itself.
+    """
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.reset()
+        threading.Thread(target=self._sample, name="memory", daemon=True).start()
+
+    def workers(self):
+        children = []
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as stat:
+                    # The parent pid follows the state, after the command name.
+                    fields = stat.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            if int(fields[1]) == self.pid:
+                children.append(int(entry))
+        return children or [self.pid]
+
+    @staticmethod
+    def resident(pid):
+        try:
+            with open(f"/proc/{pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        return 1024 * int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    def reset(self):
+        """The peaks since the last reset, in MB."""
+        with self.lock:
+            peaks = getattr(self, "peaks", None)
+            self.peaks = {"workers": 0, "total_mb": 0.0, "max_worker_mb": 0.0}
+        return peaks
+
+    def _sample(self):
+        while True:
+            sizes = [
+                size for size in map(self.resident, self.workers()) if size is not None
+            ]
+            if sizes:
+                with self.lock:
+                    self.peaks["workers"] = max(self.peaks["workers"], len(sizes))
+                    self.peaks["total_mb"] = max(
+                        self.peaks["total_mb"], round(sum(sizes) / 2**20, 1)
+                    )
+                    self.peaks["max_worker_mb"] = max(
+                        self.peaks["max_worker_mb"], round(max(sizes) / 2**20, 1)
+                    )
+            time.sleep(self.interval)
+
+
+def find_component(node, id):
+    """The props of the component with the given id in a layout tree."""
+    if isinstance(node, list):
+        for child in node:
+            found = find_component(child, id)
+            if found is not None:
+                return found
+    elif isinstance(node, dict):
+        props = node.get("props", {})
+        if props.get("id") == id:
+            return props
+        return find_component(props.get("children"), id)
+    return None
+
+
+def run_level(args, plan, users, memory):
+    """Run users respondents for args.duration seconds; that level's results."""
+    recorder = Recorder()
+    stop = threading.Event()
+
+    def respondent(index):
+        client = Client(args.url, recorder.record, args.timeout)
+        respondent = Respondent(
+            client,
+            plan,
+            random.Random(f"{args.seed}-{users}-{index}"),
+            stop,
+            args.think,
+        )
+        try:
+            while not stop.is_set():
+                try:
+                    respondent.survey()
+                except RequestFailed:
+                    # Back off briefly, rather than retrying a failing server
+                    # as fast as it can answer.
+                    stop.wait(1)
+                else:
+                    recorder.finished_survey()
+        except Stopped:
+            pass
+        finally:
+            client.close()
+
+    threads = [
+        threading.Thread(target=respondent, args=(index,), daemon=True)
+        for index in range(users)
+    ]
+    if memory is not None:
+        memory.reset()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    stop.wait(args.duration)
+    samples, surveys = recorder.take()
+    elapsed = time.perf_counter() - start
+    peaks = memory.reset() if memory is not None else None
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    by_callback = defaultdict(list)
+    errors = defaultdict(int)
+    for name, seconds, error in samples:
+        if error is None:
+            by_callback[name].append(seconds)
+        else:
+            errors[name] += 1
+    callbacks = {}
+    for name in sorted(set(by_callback) | set(errors)):
+        callbacks[name] = percentiles(by_callback[name]) if by_callback[name] else {}
+        callbacks[name]["errors"] = errors[name]
+    # Whole reports are timed end to end, on top of the requests they made.
+    requests = [
+        (name, seconds, error)
+        for name, seconds, error in samples
+        if not name.startswith("report ready")
+    ]
+    succeeded = [seconds for _, seconds, error in requests if error is None]
+    return {
+        "users": users,
+        "seconds": round(elapsed, 3),
+        "requests": len(requests),
+        "errors": len(requests) - len(succeeded),
+        "requests_per_s": round(len(requests) / elapsed, 2),
+        "surveys_per_s": round(surveys / elapsed, 3),
+        "latency": percentiles(succeeded) if succeeded else {},
+        "memory": peaks,
+        "callbacks": callbacks,
+    }
+
+
+def print_level(level):
+    latency = level["latency"]
+    memory = level["memory"] or {}
+    print(
+        f"{level['users']:>5} users {level['requests_per_s']:>9.1f} req/s "
+        f"{level['surveys_per_s']:>7.2f} surveys/s {level['errors']:>6} errors  "
+        f"p50 {latency.get('p50_ms', math.nan):>8.1f} "
+        f"p95 {latency.get('p95_ms', math.nan):>8.1f} "
+        f"p99 {latency.get('p99_ms', math.nan):>8.1f} ms  "
+        f"workers {memory.get('workers', '-')} "
+        f"{memory.get('total_mb', math.nan):.0f} MB "
+        f"(largest {memory.get('max_worker_mb', math.nan):.0f} MB)"
+    )
+    for name, result in level["callbacks"].items():
+        print(
+            f"      {name:<34} {result.get('requests', 0):>7} "
+            f"p50 {result.get('p50_ms', math.nan):>8.1f} "
+            f"p95 {result.get('p95_ms', math.nan):>8.1f} "
+            f"p99 {result.get('p99_ms', math.nan):>8.1f} ms "
+            f"{result['errors']:>5} errors"
+        )
+
+
+def read_pid(value):
+    """A pid, given as a number or as the path of a pid file."""
+    if value.isdigit():
+        return int(value)
+    with open(value) as pid_file:
+        return int(pid_file.read().strip())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8050")
+    parser.add_argument(
+        "--users",
+        default="1,2,4,8,16,32",
+        help="comma separated numbers of concurrent respondents, one level each",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=30, help="seconds to hold each level"
+    )
+    parser.add_argument(
+        "--think",
+        type=float,
+        default=0.0,
+        help="mean seconds a respondent pauses before each click (0 for none)",
+    )
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument(
+        "--pid", help="the gunicorn master's pid, or its pid file, to sample memory"
+    )
+    parser.add_argument("--framework", default=FRAMEWORK_PATH)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="loadtest_output.json")
+    parser.add_argument(
+        "--allow-remote",
+        action="store_true",
+        help="replay against a server on another host, which keeps the "
+        "synthetic respondents in its sessions and cohort",
+    )
+    args = parser.parse_args(argv)
+    if urlsplit(args.url).hostname not in LOCAL_HOSTS and not args.allow_remote:
+        parser.error(
+            f"{args.url} is not a local server; every simulated respondent "
+            "would stay in its session store and cohort. Pass --allow-remote "
+            "if that server's data is disposable."
+        )
+
+    plan = Plan(args.framework)
+    # Callbacks for another framework version are answered with 204s, which
+    # would pass for fast responses.
+    client = Client(args.url, lambda *sample: None, args.timeout)
+    layout = client.request("layout", "GET", "/_dash-layout", parse=True)
+    client.close()
+    served = (find_component(layout, "framework-version") or {}).get("data")
+    if served != plan.version:
+        parser.error(
+            f"{args.url} serves framework version {served}, "
+            f"but {args.framework} is version {plan.version}"
+        )
+
+    memory = WorkerMemory(read_pid(args.pid)) if args.pid else None
+    levels = []
+    for users in [int(users) for users in args.users.split(",")]:
+        levels.append(run_level(args, plan, users, memory))
+        print_level(levels[-1])
+
+    peak = max(levels, key=lambda level: level["requests_per_s"])
+    print(
+        f"Throughput peaked at {peak['requests_per_s']} req/s "
+        f"with {peak['users']} concurrent respondents"
+    )
+    results = {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "url": args.url,
+        "framework_version": plan.version,
+        "think": args.think,
+        "duration": args.duration,
+        "seed": args.seed,
+        "levels": levels,
+    }
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
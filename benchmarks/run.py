@@ -0,0 +1,316 @@
+"""Benchmark start up, layout serving, report callbacks and figure sizes.
+
+Every stage is timed against the real app through Flask's test client, with
+synthetic answers drawn from the framework workbook, and the results are
+written as JSON so runs on different commits can be compared:
+
+    python -m benchmarks.run --output before.json
+    python -m benchmarks.run --output after.json --compare before.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.traffic import (
+    REPORT_BUTTONS,
+    map_body,
+    poll_body,
+    random_answers,
+    random_session,
+    random_countries,
+    report_job,
+    submit_body,
+)
+
+IMPORT_SCRIPT = (
+    "import time; start = time.perf_counter(); import assessment_tool; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def summarise(seconds):
+    milliseconds = sorted(1000 * second for second in seconds)
+    return {
+        "runs": len(milliseconds),
+        "min_ms": round(milliseconds[0], 3),
+        "median_ms": round(statistics.median(milliseconds), 3),
+        "p95_ms": round(milliseconds[math.ceil(0.95 * len(milliseconds)) - 1], 3),
+        "max_ms": round(milliseconds[-1], 3),
+    }
+
+
+def timed(function, repeat):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+    return seconds, result
+
+
+def time_imports(repeat):
+    """Import the app in fresh interpreters, with and without the start up caches."""
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(os.environ, FRAMEWORK_CACHE_DIR=cache_dir)
+        for state in ["cold", "warm"]:
+            seconds = []
+            for _ in range(repeat if state == "warm" else 1):
+                output = subprocess.run(
+                    [sys.executable, "-c", IMPORT_SCRIPT],
+                    env=env,
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                ).stdout
+                seconds.append(float(output.strip().splitlines()[-1]))
+            results[f"import_{state}"] = summarise(seconds)
+    return results
+
+
+def time_loaders(repeat):
+    from country_risk import INDEX_SCORES_PATH, latest_scores
+    from framework import FRAMEWORK_PATH, parse_framework
+
+    return {
+        "parse_framework": summarise(
+            timed(lambda: parse_framework(FRAMEWORK_PATH), max(1, repeat // 5))[0]
+        ),
+        "latest_scores": summarise(
+            timed(lambda: latest_scores(INDEX_SCORES_PATH), max(1, repeat // 5))[0]
+        ),
+    }
+
+
+def time_layout(app, client, repeat):
+    import plotly
+
+    seconds, body = timed(
+        lambda: json.dumps(app._layout_value(), cls=plotly.utils.PlotlyJSONEncoder),
+        repeat,
+    )
+    results = {"layout_serialise": summarise(seconds)}
+    results["layout_serialise"]["bytes"] = len(body)
+    for encoding in ["identity", "gzip"]:
+        seconds, response = timed(
+            lambda: client.get("/_dash-layout", headers={"Accept-Encoding": encoding}),
+            repeat,
+        )
+        results[f"layout_{encoding}"] = summarise(seconds)
+        results[f"layout_{encoding}"]["bytes"] = len(response.data)
+    return results
+
+
+def post(client, body):
+    response = client.post("/_dash-update-component", json=body)
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code}: {response.data[:200]!r}")
+    return response
+
+
+def figure_bytes(children):
+    """Serialised size of every figure in a report's component tree."""
+    sizes = []
+
+    def walk(node):
+        if isinstance(node, list):
+            for child in node:
+                walk(child)
+        elif isinstance(node, dict):
+            props = node.get("props", {})
+            if "figure" in props:
+                sizes.append(len(json.dumps(props["figure"])))
+            walk(props.get("children"))
+
+    walk(children)
+    return sizes
+
+
+def report_children(client, button_id, session, response):
+    """A report's component tree, polled for as the page would if still building."""
+    # A MATCH output comes back keyed by its component id.
+    (output,) = response.get_json()["response"].values()
+    job = report_job(output["children"])
+    if job is None:
+        return output["children"]
+    key, interval = job
+    n_intervals = 0
+    while True:
+        # The page's Interval first fires one interval after it is shown.
+        time.sleep(interval)
+        n_intervals += 1
+        outputs = post(
+            client, poll_body(button_id, key, n_intervals, session)
+        ).get_json()["response"]
+        if any(props.get("disabled") for props in outputs.values()):
+            break
+    (children,) = [
+        props["children"]
+        for id, props in outputs.items()
+        if json.loads(id)["type"] == "report-job-output"
+    ]
+    # Reports are lists; anything else is the message of a failed job.
+    if not isinstance(children, list):
+        raise RuntimeError(json.dumps(children)[:200])
+    return children
+
+
+def time_reports(app_module, client, rng, repeat):
+    survey = app_module.surveys.current
+    data, model = survey.data, survey.scoring_model
+    countries = app_module.country_risk.countries
+    results = {}
+    for button_id in REPORT_BUTTONS:
+        sessions, bodies = [], []
+        for _ in range(repeat):
+            # Answers are saved as update_live_scores would have saved them.
+            session = random_session(rng)
+            answers = random_answers(data, model, rng)
+            survey.session_store.apply(session, list(enumerate(answers)))
+            sessions.append(session)
+            bodies.append(
+                submit_body(
+                    button_id,
+                    session,
+                    survey.digest,
+                    random_countries(countries, rng),
+                    random_countries(countries, rng),
+                )
+            )
+        try:
+            # Distinct answers per run, so every request misses the report cache.
+            seconds = []
+            for session, body in zip(sessions, bodies):
+                start = time.perf_counter()
+                children = report_children(
+                    client, button_id, session, post(client, body)
+                )
+                seconds.append(time.perf_counter() - start)
+            cached, _ = timed(lambda: post(client, bodies[-1]), repeat)
+        except Exception as error:
+            results[button_id] = {"error": f"{type(error).__name__}: {error}"}
+            continue
+        results[button_id] = summarise(seconds)
+        results[button_id]["cached"] = summarise(cached)
+        results[button_id]["bytes"] = len(json.dumps(children))
+        results[button_id]["figure_bytes"] = figure_bytes(children)
+    return results
+
+
+def time_map(app_module, client, rng, repeat):
+    store = app_module.country_risk
+    bodies = [
+        map_body(
+            rng.choice(list(store.issues)),
+            random_countries(store.countries, rng),
+            random_countries(store.countries, rng),
+        )
+        for _ in range(repeat)
+    ]
+    seconds = []
+    for body in bodies:
+        start = time.perf_counter()
+        response = post(client, body)
+        seconds.append(time.perf_counter() - start)
+    results = summarise(seconds)
+    results["figure_bytes"] = [len(response.data)]
+    return {"map": results}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Print the change in median time for every stage both runs share."""
+    for group, stages in results["stages"].items():
+        for name, result in stages.items():
+            before = baseline["stages"].get(group, {}).get(name, {})
+            if "median_ms" in result and "median_ms" in before:
+                ratio = result["median_ms"] / before["median_ms"]
+                print(
+                    f"{group}.{name:<24} {before['median_ms']:>10.3f} ms -> "
+                    f"{result['median_ms']:>10.3f} ms  ({ratio:.2f}x)"
+                )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--compare", help="earlier JSON results to compare against")
+    parser.add_argument(
+        "--skip-imports",
+        action="store_true",
+        help="don't time the app import in fresh interpreters",
+    )
+    args = parser.parse_args(argv)
+    rng = random.Random(args.seed)
+
+    # Measure rendering, not the report cache; cache hits are timed by
+    # repeating a request instead.
+    os.environ["REPORT_CACHE_SIZE"] = "1"
+    os.environ.pop("REPORT_CACHE_PATH", None)
+    # Everything the app writes goes to a scratch directory, so a run neither
+    # picks up the report jobs an earlier run finished nor leaves its
+    # synthetic respondents in the saved sessions and the cohort.
+    scratch = tempfile.TemporaryDirectory()
+    for variable, name in [
+        ("JOB_QUEUE_PATH", "jobs.sqlite"),
+        ("SESSION_STORE_PATH", "sessions.sqlite"),
+        ("COHORT_PATH", "cohort.sqlite"),
+        ("FRAMEWORK_CACHE_DIR", "framework_cache"),
+    ]:
+        os.environ[variable] = os.path.join(scratch.name, name)
+
+    stages = {}
+    if not args.skip_imports:
+        stages["startup"] = time_imports(max(1, args.repeat // 4))
+    stages["loaders"] = time_loaders(args.repeat)
+
+    import assessment_tool
+
+    client = assessment_tool.app.server.test_client()
+    stages["layout"] = time_layout(assessment_tool.app, client, args.repeat)
+    stages["reports"] = time_reports(assessment_tool, client, rng, args.repeat)
+    stages["reports"].update(time_map(assessment_tool, client, rng, args.repeat))
+
+    results = {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "seed": args.seed,
+        "answer_slots": len(assessment_tool.surveys.current.scoring_model.ids),
+        "stages": stages,
+    }
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print(json.dumps(stages, indent=2))
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
+    scratch.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""Synthetic survey traffic built from the framework workbook.
+
+Shared by the benchmark suite and the load test: random but valid answer
+vectors and session ids, and the JSON bodies the Dash renderer posts for
+each callback.
+"""
+import json
+
+from scoring import UNANSWERED
+
+REPORT_BUTTONS = ["results", "Materiality", "Due diligence", "Mitigation", "geographic"]
+
+
+def random_answers(data, model, rng, blank=0.1):
+    """An encoded answer vector drawing from each question's own options."""
+    choices = {
+        str(reference): [value for _, value in data.question(row)["Answer choices"]]
+        for row, reference in enumerate(data.references)
+    }
+    return [
+        UNANSWERED if rng.random() < blank else rng.choice(choices[id.split("-", 1)[0]])
+        for id in model.ids
+    ]
+
+
+def random_session(rng):
+    return "%032x" % rng.getrandbits(128)
+
+
+def random_countries(countries, rng, most=5):
+    return rng.sample(list(countries), rng.randint(0, min(most, len(countries))))
+
+
+def _prop_id(id, prop):
+    if isinstance(id, dict):
+        id = json.dumps(id, sort_keys=True, separators=(",", ":"))
+    return f"{id}.{prop}"
+
+
+def submit_body(
+    button_id,
+    session,
+    version,
+    business_countries=None,
+    supply_countries=None,
+    delta=None,
+):
+    """The body of a survey-submit click for display_dropdowns."""
+    submit = {"type": "survey-submit", "index": button_id}
+    return {
+        "output": '{"index":["MATCH"],"type":"survey-results"}.children',
+        "outputs": {
+            "id": {"type": "survey-results", "index": button_id},
+            "property": "children",
+        },
+        "inputs": [{"id": submit, "property": "n_clicks", "value": 1}],
+        "state": [
+            {"id": "session", "property": "data", "value": session},
+            {"id": "answer-delta", "property": "data", "value": delta},
+            {"id": "framework-version", "property": "data", "value": version},
+            {
+                "id": "business-countries",
+                "property": "value",
+                "value": business_countries,
+            },
+            {"id": "supply-countries", "property": "value", "value": supply_countries},
+        ],
+        "changedPropIds": [_prop_id(submit, "n_clicks")],
+    }
+
+
+def delta_body(session, version, number, changes, slots):
+    """The body of the number'th batch of changed answers for update_live_scores.
+
+    version, here and below, is the framework digest the page was built from;
+    slots are the question ids of its answer slots.
+    """
+    return {
+        "output": "live-scores.data",
+        "outputs": {"id": "live-scores", "property": "data"},
+        "inputs": [
+            {
+                "id": "answer-delta",
+                "property": "data",
+                "value": {"version": number, "changes": changes},
+            }
+        ],
+        "state": [
+            {"id": "session", "property": "data", "value": session},
+            {"id": "framework-version", "property": "data", "value": version},
+            {"id": "answer-slots", "property": "data", "value": slots},
+        ],
+        "changedPropIds": ["answer-delta.data"],
+    }
+
+
+def render_tab_body(category, categories, version, rendered=(), session=None):
+    """The body of activating a question tab for render_tab."""
+    return {
+        "output": '..{"index":["ALL"],"type":"question-form"}.children'
+        "...rendered-tabs.data..",
+        "outputs": [
+            [
+                {
+                    "id": {"type": "question-form", "index": name},
+                    "property": "children",
+                }
+                for name in categories
+            ],
+            {"id": "rendered-tabs", "property": "data"},
+        ],
+        "inputs": [
+            {"id": "assessment-tabs", "property": "active_tab", "value": category}
+        ],
+        "state": [
+            {"id": "rendered-tabs", "property": "data", "value": list(rendered)},
+            {"id": "session", "property": "data", "value": session},
+            {"id": "framework-version", "property": "data", "value": version},
+        ],
+        "changedPropIds": ["assessment-tabs.active_tab"],
+    }
+
+
+def peer_scores_body(session, version, delta=None):
+    """The body of the results submit click for update_peer_scores."""
+    submit = {"type": "survey-submit", "index": "results"}
+    return {
+        "output": "..peer-scores.data...peer-count.children..",
+        "outputs": [
+            {"id": "peer-scores", "property": "data"},
+            {"id": "peer-count", "property": "children"},
+        ],
+        "inputs": [{"id": submit, "property": "n_clicks", "value": 1}],
+        "state": [
+            {"id": "session", "property": "data", "value": session},
+            {"id": "answer-delta", "property": "data", "value": delta},
+            {"id": "framework-version", "property": "data", "value": version},
+        ],
+        "changedPropIds": [_prop_id(submit, "n_clicks")],
+    }
+
+
+def report_job(children):
+    """The job key and poll interval (s) of a report still being built, or None.
+
+    children is what display_dropdowns returned: reports are lists of
+    components, one still being built is a single Div holding the job's key
+    in a report-job store and the Interval that polls for it.
+    """
+    if not isinstance(children, dict):
+        return None
+    props = {
+        child["props"].get("id", {}).get("type"): child["props"]
+        for child in children["props"]["children"]
+    }
+    return props["report-job"]["data"], props["report-poll"]["interval"] / 1000
+
+
+def poll_body(button_id, key, n_intervals, session):
+    """The body of one tick of a report job's interval for poll_report."""
+    outputs = [
+        ("report-job-output", "children"),
+        ("report-progress", "value"),
+        ("report-progress", "children"),
+        ("report-job-status", "style"),
+        ("report-poll", "disabled"),
+    ]
+    poll = {"type": "report-poll", "index": button_id}
+    return {
+        "output": "..%s.."
+        % "...".join(
+            _prop_id({"index": ["MATCH"], "type": type}, prop) for type, prop in outputs
+        ),
+        "outputs": [
+            {"id": {"type": type, "index": button_id}, "property": prop}
+            for type, prop in outputs
+        ],
+        "inputs": [{"id": poll, "property": "n_intervals", "value": n_intervals}],
+        "state": [
+            {
+                "id": {"type": "report-job", "index": button_id},
+                "property": "data",
+                "value": key,
+            },
+            {"id": "session", "property": "data", "value": session},
+        ],
+        "changedPropIds": [_prop_id(poll, "n_intervals")],
+    }
+
+
+def map_body(issue, business_countries=None, supply_countries=None):
+    """The body of an issue or country change for update_map."""
+    return {
+        "output": "map.figure",
+        "outputs": {"id": "map", "property": "figure"},
+        "inputs": [
+            {"id": "map-issue", "property": "value", "value": issue},
+            {
+                "id": "business-countries",
+                "property": "value",
+                "value": business_countries,
+            },
+            {"id": "supply-countries", "property": "value", "value": supply_countries},
+        ],
+        "changedPropIds": ["map-issue.value"],
+    }
@@ -0,0 +1,325 @@
+"""Where one respondent's scores stand among all the others.
+
+Every row of the score tables ((Scope, Issue) for Business and Supply Chain,
+then the Combined issues) has a fixed histogram for each of Score,
+combined_score and priority_score, counting respondents per score bin.
+Recording a respondent moves one count per histogram, out of the bin their
+previous scores fell in and into the new one. A percentile or a median is read
+from the bin counts alone, so neither depends on how many respondents there
+are.
+
+Counts live in SQLite (WAL) so every worker shares them, next to the bins
+each respondent was last counted in. Each process keeps a copy of the
+histograms. It applies its own updates to the copy straight away and reloads
+the copy when other processes have changed the counts, at most every
+COHORT_REFRESH seconds.
+
+    python cohort.py    recount the cohort from the session store
+"""
+import argparse
+import hashlib
+import os
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+import sessions
+from framework import load_framework
+from scoring import UNANSWERED, ScoringModel
+from storage import Database, data_path
+
+METRICS = ["Score", "combined_score", "priority_score"]
+
+# Scores are clipped into [LOW, HIGH]; a bin is (HIGH - LOW) / BINS wide.
+LOW = 0.0
+HIGH = 8.0
+BINS = 800
+
+
+def row_keys(model):
+    """The (Scope, Issue) of every row the cohort counts, in order."""
+    return [
+        *zip(model.row_scope, model.row_issue),
+        *(("Combined", issue) for issue in model.combined_issues),
+    ]
+
+
+def row_values(model, answers):
+    """METRICS of every row, shape (respondents, len(METRICS), rows)."""
+    arrays = model.reduce(np.atleast_2d(answers))
+    return np.stack(
+        [
+            np.hstack([arrays[f"row_{column}"].astype(float), arrays["combined"][name]])
+            for name, column in [
+                ("Score", "score"),
+                ("combined_score", "combined"),
+                ("priority_score", "priority"),
+            ]
+        ],
+        axis=1,
+    )
+
+
+class Cohort:
+    def __init__(self, path, keys, bins=BINS, low=LOW, high=HIGH, refresh=1.0):
+        self.path = path
+        self.keys = keys
+        self.bins = bins
+        self.low = low
+        self.width = (high - low) / bins
+        self.refresh = refresh
+        self.shape = (len(METRICS), len(keys), bins)
+        # Counts kept against different rows or bins are not reused.
+        self.layout = hashlib.sha256(
+            repr((keys, bins, low, high)).encode()
+        ).hexdigest()[:16]
+        self.counts = np.zeros(self.shape, dtype=np.int64)
+        self.cumulative = None
+        self.version = None
+        self.checked = 0.0
+        self.lock = threading.Lock()
+        self.database = Database(
+            path,
+            [
+                "CREATE TABLE IF NOT EXISTS cohort_members (id TEXT PRIMARY KEY, "
+                "layout TEXT NOT NULL, bins BLOB NOT NULL)",
+                "CREATE TABLE IF NOT EXISTS cohort_counts (layout TEXT NOT NULL, "
+                "cell INTEGER NOT NULL, count INTEGER NOT NULL, "
+                "PRIMARY KEY (layout, cell))",
+                "CREATE TABLE IF NOT EXISTS cohort_versions "
+                "(layout TEXT PRIMARY KEY, version INTEGER NOT NULL)",
+            ],
+        )
+
+    def codes(self, values):
+        """The bin of each value (-1 for NaN), in the shape of values."""
+        values = np.asarray(values, dtype=float)
+        codes = np.floor((values - self.low) / self.width)
+        codes = np.clip(np.nan_to_num(codes, nan=-1), 0, self.bins - 1)
+        codes[np.isnan(values)] = -1
+        return codes.astype(np.int16)
+
+    def cells(self, codes):
+        """Flat histogram cells of a respondent's (METRICS x rows) bin codes."""
+        codes = codes.ravel()
+        present = np.flatnonzero(codes >= 0)
+        return present * self.bins + codes[present]
+
+    def record(self, member, values):
+        """Count a respondent's (METRICS x rows) scores, replacing earlier ones.
+
+        Returns False if the scores fall in the bins already counted.
+        """
+        codes = self.codes(values)
+        connection = self.database.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT layout, bins FROM cohort_members WHERE id = ?", (member,)
+            ).fetchone()
+            previous = None
+            if row is not None and row[0] == self.layout:
+                previous = np.frombuffer(row[1], dtype=np.int16)
+                if np.array_equal(previous, codes.ravel()):
+                    connection.execute("ROLLBACK")
+                    return False
+            changes = Counter(self.cells(codes).tolist())
+            if previous is not None:
+                changes.subtract(self.cells(previous).tolist())
+            changes = [(cell, change) for cell, change in changes.items() if change]
+            connection.executemany(
+                "INSERT INTO cohort_counts (layout, cell, count) VALUES (?, ?, ?) "
+                "ON CONFLICT (layout, cell) "
+                "DO UPDATE SET count = count + excluded.count",
+                [(self.layout, cell, change) for cell, change in changes],
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO cohort_members (id, layout, bins) "
+                "VALUES (?, ?, ?)",
+                (member, self.layout, codes.tobytes()),
+            )
+            version = self._bump(connection)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        with self.lock:
+            # Only a copy that was current before this update can take it;
+            # any other reloads it all on the next refresh.
+            if self.version == version - 1:
+                if changes:
+                    cells, deltas = zip(*changes)
+                    np.add.at(self.counts.reshape(-1), list(cells), deltas)
+                self.cumulative = None
+                self.version = version
+        return True
+
+    def member_ids(self):
+        """Everyone counted, in this layout or any other."""
+        connection = self.database.connection()
+        return {id for id, in connection.execute("SELECT id FROM cohort_members")}
+
+    def rebuild(self, members):
+        """Recount the cohort from scratch from (member, values) pairs."""
+        counts = np.zeros(np.prod(self.shape), dtype=np.int64)
+        rows = []
+        for member, values in members:
+            codes = self.codes(values)
+            counts[self.cells(codes)] += 1
+            rows.append((member, self.layout, codes.tobytes()))
+        connection = self.database.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "DELETE FROM cohort_members WHERE layout = ?", (self.layout,)
+            )
+            connection.execute(
+                "DELETE FROM cohort_counts WHERE layout = ?", (self.layout,)
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO cohort_members (id, layout, bins) "
+                "VALUES (?, ?, ?)",
+                rows,
+            )
+            connection.executemany(
+                "INSERT INTO cohort_counts (layout, cell, count) VALUES (?, ?, ?)",
+                [
+                    (self.layout, int(cell), int(counts[cell]))
+                    for cell in np.flatnonzero(counts)
+                ],
+            )
+            self._bump(connection)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        self.checked = 0.0
+        return len(rows)
+
+    def _bump(self, connection):
+        connection.execute(
+            "INSERT INTO cohort_versions (layout, version) VALUES (?, 1) "
+            "ON CONFLICT (layout) DO UPDATE SET version = version + 1",
+            (self.layout,),
+        )
+        return connection.execute(
+            "SELECT version FROM cohort_versions WHERE layout = ?", (self.layout,)
+        ).fetchone()[0]
+
+    def _refresh(self):
+        now = time.time()
+        if now - self.checked < self.refresh:
+            return
+        connection = self.database.connection()
+        row = connection.execute(
+            "SELECT version FROM cohort_versions WHERE layout = ?", (self.layout,)
+        ).fetchone()
+        version = 0 if row is None else row[0]
+        with self.lock:
+            self.checked = now
+            if version == self.version:
+                return
+        # Read the counts and their version in one snapshot.
+        connection.execute("BEGIN")
+        try:
+            row = connection.execute(
+                "SELECT version FROM cohort_versions WHERE layout = ?", (self.layout,)
+            ).fetchone()
+            cells = connection.execute(
+                "SELECT cell, count FROM cohort_counts WHERE layout = ? AND count != 0",
+                (self.layout,),
+            ).fetchall()
+        finally:
+            connection.execute("COMMIT")
+        counts = np.zeros(self.shape, dtype=np.int64)
+        if cells:
+            cell, count = np.array(cells, dtype=np.int64).T
+            counts.reshape(-1)[cell] = count
+        with self.lock:
+            self.counts = counts
+            self.cumulative = None
+            self.version = 0 if row is None else row[0]
+
+    def _cumulative(self):
+        """Respondents below each bin edge, shape (METRICS, rows, bins + 1)."""
+        self._refresh()
+        with self.lock:
+            if self.cumulative is None:
+                cumulative = np.zeros(self.shape[:2] + (self.bins + 1,), np.int64)
+                np.cumsum(self.counts, axis=2, out=cumulative[:, :, 1:])
+                self.cumulative = cumulative
+            return self.cumulative
+
+    def sizes(self):
+        """Respondents with a score in each histogram, shape (METRICS, rows)."""
+        return self._cumulative()[:, :, -1]
+
+    def percentiles(self, values):
+        """Percentile rank (0-100) of (METRICS x rows) scores in the cohort.
+
+        Respondents in the same bin count as half below, half above. NaN
+        where the score is missing or nobody else has one.
+        """
+        cumulative = self._cumulative()
+        codes = self.codes(values)
+        metric, row = np.indices(codes.shape)
+        bins = np.maximum(codes, 0)
+        below = cumulative[metric, row, bins]
+        within = cumulative[metric, row, bins + 1] - below
+        total = cumulative[:, :, -1]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ranks = 100 * (below + within / 2) / total
+        return np.where((codes >= 0) & (total > 0), ranks, np.nan)
+
+    def quantiles(self, q):
+        """The q-quantile (0-1) of each histogram, as its bin's midpoint."""
+        cumulative = self._cumulative()
+        total = cumulative[:, :, -1]
+        bins = np.argmax(cumulative[:, :, 1:] >= q * total[:, :, None], axis=2)
+        return np.where(total > 0, self.low + (bins + 0.5) * self.width, np.nan)
+
+
+def from_environment(model):
+    path = os.environ.get("COHORT_PATH")
+    if path is None:
+        path = data_path("cohort.sqlite")
+    return Cohort(
+        path,
+        row_keys(model),
+        refresh=float(os.environ.get("COHORT_REFRESH", 1.0)),
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Recount the cohort from its members' saved answers."
+    )
+    parser.add_argument("--chunksize", type=int, default=10000)
+    args = parser.parse_args(argv)
+
+    model = ScoringModel(load_framework())
+    store = sessions.from_environment(model.ids)
+    cohort = from_environment(model)
+    # Only sessions update_peer_scores counted are recounted: respondents
+    # join the cohort by asking for their results, not by answering.
+    counted = cohort.member_ids()
+
+    def members():
+        for chunk in store.chunks(args.chunksize):
+            chunk = [
+                (id, encoded)
+                for id, encoded in chunk
+                if id in counted and (encoded != UNANSWERED).any()
+            ]
+            if chunk:
+                ids, encoded = zip(*chunk)
+                answers = np.stack([model.decode_answers(vector) for vector in encoded])
+                yield from zip(ids, row_values(model, answers))
+
+    print(f"Counted {cohort.rebuild(members())} respondents into {cohort.path}")
+
+
+if __name__ == "__main__":
+    main()
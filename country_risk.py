@@ -0,0 +1,220 @@
+"""Country risk scores from the Children's Rights and Business Atlas export.
+
+IndexScores.csv holds every indicator for every year. Only the latest
+ISSUE_INDEX_SCORE per country and issue is used, so the CSV is collapsed once
+into a dense country x issue matrix and persisted as columnar arrays keyed by
+the CSV's content hash. Later starts load the arrays instead of the CSV.
+"""
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from framework import CACHE_DIR, file_digest
+
+INDEX_SCORES_PATH = "IndexScores.csv"
+
+# Framework issues the Atlas names differently. Other issues match by name.
+ISSUE_ALIASES = {
+    "Decent work": "Decent working conditions",
+    "Maternity protections": "Maternity and paternity protection",
+    "Disaster preparedness": "Natural disasters",
+    "Environment and natural resources": "Resource use and damage to the environment",
+    "Land use and acquisition": "Community and Environment",
+}
+
+# Bump when the shape or meaning of the persisted arrays changes.
+CACHE_VERSION = 2
+
+
+def latest_scores(path=INDEX_SCORES_PATH):
+    """The last score of the latest TIME_PERIOD per country and issue.
+
+    Rows without a score are skipped, so a missing score in the latest period
+    leaves the one before it in place.
+    """
+    index_scores = pd.read_csv(
+        path,
+        encoding="unicode_escape",
+        usecols=[
+            "COUNTRY_ISO_3",
+            "INDICATOR_ISSUE",
+            "TIME_PERIOD",
+            "ISSUE_INDEX_SCORE",
+        ],
+    )
+    return (
+        index_scores.dropna(subset=["ISSUE_INDEX_SCORE"])
+        .sort_values(["COUNTRY_ISO_3", "INDICATOR_ISSUE", "TIME_PERIOD"], kind="stable")
+        .drop_duplicates(["COUNTRY_ISO_3", "INDICATOR_ISSUE"], keep="last")
+        .reset_index(drop=True)
+    )
+
+
+class CountryRiskStore:
+    def __init__(self, countries, issues, scores, periods):
+        self.countries = countries
+        self.issues = issues
+        self.scores = scores
+        self.periods = periods
+        self.country_index = {country: row for row, country in enumerate(countries)}
+        self.issue_index = {issue: column for column, issue in enumerate(issues)}
+
+    @classmethod
+    def from_frame(cls, latest):
+        countries = np.array(sorted(latest["COUNTRY_ISO_3"].unique()))
+        issues = np.array(sorted(latest["INDICATOR_ISSUE"].unique()))
+        rows = np.searchsorted(countries, latest["COUNTRY_ISO_3"])
+        columns = np.searchsorted(issues, latest["INDICATOR_ISSUE"])
+        scores = np.full((len(countries), len(issues)), np.nan)
+        scores[rows, columns] = latest["ISSUE_INDEX_SCORE"]
+        periods = np.zeros((len(countries), len(issues)), dtype=np.int32)
+        periods[rows, columns] = latest["TIME_PERIOD"]
+        return cls(countries, issues, scores, periods)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(
+                arrays["countries"],
+                arrays["issues"],
+                arrays["scores"],
+                arrays["periods"],
+            )
+
+    def save(self, path):
+        # Write to a private file first so concurrent workers never read a
+        # partially written store.
+        partial = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            partial,
+            countries=self.countries,
+            issues=self.issues,
+            scores=self.scores,
+            periods=self.periods,
+        )
+        os.replace(partial, path)
+
+    def rows(self, countries):
+        return [
+            self.country_index[country]
+            for country in countries or []
+            if country in self.country_index
+        ]
+
+
+class IssueCountryMatrix:
+    """A CountryRiskStore's latest scores for a framework's issues.
+
+    scores is dense, issues x countries, in the framework's issue order and
+    names, NaN where the Atlas has no score. Scoring any selection of
+    countries against any set of issue weights is then a single matrix
+    product over the selected columns.
+    """
+
+    def __init__(self, store, issues):
+        self.store = store
+        self.issues = np.asarray(issues, dtype=object)
+        self.countries = store.countries
+        self.issue_index = {issue: row for row, issue in enumerate(self.issues)}
+        columns = np.array(
+            [
+                store.issue_index.get(ISSUE_ALIASES.get(issue, issue), -1)
+                for issue in self.issues
+            ],
+            dtype=np.int64,
+        )
+        matched = columns >= 0
+        # Unmatched issues drop out of every country's risk, which quietly
+        # changes rankings; a missing or wrong alias should be seen.
+        self.unmatched = [str(issue) for issue in self.issues[~matched]]
+        for issue in self.unmatched:
+            name = ISSUE_ALIASES.get(issue, issue)
+            warnings.warn(
+                f"framework issue {issue!r} has no country risk scores: "
+                f"no {name!r} issue in the Atlas export",
+                stacklevel=2,
+            )
+        self.scores = np.full((len(self.issues), len(self.countries)), np.nan)
+        self.scores[matched] = store.scores[:, columns[matched]].T
+        self.periods = np.zeros(self.scores.shape, dtype=np.int32)
+        self.periods[matched] = store.periods[:, columns[matched]].T
+        present = ~np.isnan(self.scores)
+        # Score sums and counts side by side, so one product gives both.
+        self.stacked = np.stack([np.where(present, self.scores, 0), present])
+
+    def mask(self, countries):
+        """Which columns the given countries are."""
+        mask = np.zeros(len(self.countries), dtype=bool)
+        mask[self.store.rows(countries)] = True
+        return mask
+
+    def combined(self, weights, mask):
+        """Weighted mean score over issues of each selected country.
+
+        weights is (groups x issues), e.g. one row of priority weights per
+        scope; the result is (groups x selected countries), NaN where no
+        weighted issue has a score.
+        """
+        totals, counts = np.asarray(weights, dtype=float) @ self.stacked[:, :, mask]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(counts > 0, totals / counts, np.nan)
+
+    def ranked(self, issues, mask):
+        """The selected countries' scores for each issue, highest first.
+
+        Returns (issue, country, score, period, rank) rows; countries without
+        a score for an issue are left out.
+        """
+        countries = self.countries[mask]
+        rows = []
+        for issue in issues:
+            if issue not in self.issue_index:
+                continue
+            scores = self.scores[self.issue_index[issue], mask]
+            periods = self.periods[self.issue_index[issue], mask]
+            present = np.flatnonzero(~np.isnan(scores))
+            order = present[np.argsort(-scores[present], kind="stable")]
+            rows.extend(
+                (issue, countries[i], scores[i], periods[i], rank)
+                for rank, i in enumerate(order, 1)
+            )
+        return rows
+
+    def frame(self, countries=None):
+        """Latest scores in long form by framework issue, as in CountryRiskStore."""
+        mask = (
+            np.ones(len(self.countries), dtype=bool)
+            if countries is None
+            else self.mask(countries)
+        )
+        scores = self.scores[:, mask]
+        present = ~np.isnan(scores)
+        issue, country = np.nonzero(present)
+        return pd.DataFrame(
+            {
+                "COUNTRY_ISO_3": self.countries[mask][country],
+                "Issue": self.issues[issue],
+                "TIME_PERIOD": self.periods[:, mask][present],
+                "ISSUE_INDEX_SCORE": scores[present],
+            }
+        )
+
+
+def load_country_risk(path=INDEX_SCORES_PATH, cache_dir=CACHE_DIR):
+    snapshot = os.path.join(
+        cache_dir, f"country-risk-v{CACHE_VERSION}-{file_digest(path)[:16]}.npz"
+    )
+    try:
+        return CountryRiskStore.load(snapshot)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    store = CountryRiskStore.from_frame(latest_scores(path))
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        store.save(snapshot)
+    except OSError:
+        pass
+    return store
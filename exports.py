@@ -0,0 +1,192 @@
+"""Download scored reports as CSV or XLSX.
+
+    GET  /export/<table>.<format>?session=<id>&business=AFG&supply=BGD
+    GET  /export/<table>.<format>?answers=3,1,-1,...&business=AFG&supply=BGD
+    POST /export/<table>.<format>   (file field "answers", CSV or Parquet)
+
+table is "scores" (the Business, Supply Chain and Combined tables) or
+"geographic" (priority issues joined with the selected countries' risk
+scores). GET scores the answers of one respondent, either saved in the
+session store or given as an encoded answer vector. POST scores an uploaded
+file laid out like batch_scoring's input, optionally with an id_column form
+field.
+
+Uploads are read and scored a chunk of respondents at a time. CSV rows are
+streamed as each chunk is scored. XLSX rows are written to a temporary file
+by openpyxl's write-only mode, and the file is streamed once it is complete.
+"""
+import io
+import itertools
+import os
+import tempfile
+
+import flask
+import pandas as pd
+
+from batch_scoring import numbered_chunks, read_chunks, score_answers
+from sessions import valid_session
+
+CHUNKSIZE = int(os.environ.get("EXPORT_CHUNKSIZE", 2000))
+
+GEOGRAPHIC_COLUMNS = [
+    "respondent",
+    "Scope",
+    "Issue",
+    "priority_score",
+    "priority",
+    "COUNTRY_ISO_3",
+    "TIME_PERIOD",
+    "ISSUE_INDEX_SCORE",
+]
+
+MIMETYPES = {
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+def geographic_rows(results, country_scores):
+    """Priority issues of each scope joined with that scope's country scores.
+
+    country_scores maps "Business" and "Supply Chain" to long form country
+    risk frames, as returned by IssueCountryMatrix.frame.
+    """
+    frames = []
+    for scope, scores in country_scores.items():
+        priorities = results[
+            (results["Scope"] == scope) & (results["priority_score"] < 2)
+        ]
+        frames.append(
+            priorities.astype({"Scope": str, "Issue": str}).merge(
+                scores, on="Issue", how="left"
+            )
+        )
+    return pd.concat(frames, ignore_index=True)[GEOGRAPHIC_COLUMNS]
+
+
+def csv_stream(frames):
+    header = True
+    for frame in frames:
+        buffer = io.StringIO()
+        frame.to_csv(buffer, header=header, index=False)
+        header = False
+        yield buffer.getvalue()
+
+
+def xlsx_stream(frames, title):
+    import openpyxl
+
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet(title)
+    header = True
+    for frame in frames:
+        if header:
+            worksheet.append(list(frame.columns))
+            header = False
+        for row in frame.astype(object).itertuples(index=False):
+            worksheet.append([None if pd.isna(value) else value for value in row])
+    with tempfile.TemporaryFile() as output:
+        workbook.save(output)
+        output.seek(0)
+        yield from iter(lambda: output.read(1 << 16), b"")
+
+
+def _countries(values, name):
+    return [country for value in values.getlist(name) for country in value.split(",")]
+
+
+def register(app, surveys):
+    """Serve /export/<table>.<format> from a Dash app's Flask server.
+
+    surveys is the app's FrameworkRegistry, whose current version has the
+    scoring_model, session_store and issue_risk to use.
+    """
+
+    @app.server.route("/export/<table>.<format>", methods=["GET", "POST"])
+    def export(table, format):
+        if table not in ("scores", "geographic") or format not in MIMETYPES:
+            flask.abort(404)
+        values = flask.request.values
+        survey = surveys.current
+        model = survey.scoring_model
+
+        if flask.request.method == "POST":
+            upload = flask.request.files.get("answers")
+            if upload is None:
+                return flask.Response(
+                    "upload answers as the 'answers' file field\n",
+                    status=400,
+                    mimetype="text/plain",
+                )
+            id_column = values.get("id_column") or None
+            chunks = numbered_chunks(
+                read_chunks(
+                    upload.stream,
+                    CHUNKSIZE,
+                    parquet=(upload.filename or "").endswith(".parquet"),
+                ),
+                id_column,
+            )
+            try:
+                first = next(chunks, None)
+            except ValueError as error:
+                return flask.Response(
+                    f"unreadable answers: {error}\n",
+                    status=400,
+                    mimetype="text/plain",
+                )
+            if first is not None and id_column and id_column not in first:
+                return flask.Response(
+                    f"no {id_column!r} column in the answers\n",
+                    status=400,
+                    mimetype="text/plain",
+                )
+            chunks = itertools.chain([] if first is None else [first], chunks)
+        else:
+            session = values.get("session")
+            try:
+                if session:
+                    if not valid_session(session):
+                        raise ValueError(f"invalid session {session!r}")
+                    encoded = survey.session_store.answers(session)
+                else:
+                    encoded = [
+                        int(value) for value in values.get("answers", "").split(",")
+                    ]
+                answers = model.decode_answers(encoded)
+            except ValueError as error:
+                return flask.Response(f"{error}\n", status=400, mimetype="text/plain")
+            id_column = None
+            chunks = [pd.DataFrame(answers[None, :], columns=model.ids)]
+
+        country_scores = {
+            "Business": survey.issue_risk.frame(_countries(values, "business")),
+            "Supply Chain": survey.issue_risk.frame(_countries(values, "supply")),
+        }
+
+        scored = (score_answers(model, chunk, id_column) for chunk in chunks)
+        # Read and score the first chunk before the response starts, while an
+        # error (e.g. no answer columns) can still be reported with a status
+        # code rather than cutting the download short.
+        try:
+            first = next(scored, None)
+        except ValueError as error:
+            return flask.Response(f"{error}\n", status=400, mimetype="text/plain")
+        scored = itertools.chain([] if first is None else [first], scored)
+
+        def frames():
+            for results in scored:
+                if table == "geographic":
+                    results = geographic_rows(results, country_scores)
+                yield results
+
+        stream = (
+            csv_stream(frames()) if format == "csv" else xlsx_stream(frames(), table)
+        )
+        response = flask.Response(
+            flask.stream_with_context(stream), mimetype=MIMETYPES[format]
+        )
+        response.headers[
+            "Content-Disposition"
+        ] = f'attachment; filename="{table}.{format}"'
+        return response
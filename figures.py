@@ -0,0 +1,175 @@
+"""Report figures built directly as plotly figure dicts.
+
+plotly.express validates a DataFrame, resolves the full default template and
+embeds it in every figure. The report charts always have the same shape, so
+their layouts are built once here and each request only fills in the traces.
+The base choropleth trace for each issue is built once at start up.
+"""
+import numpy as np
+import plotly.colors
+
+# The parts of plotly's default template that the report charts use.
+TEMPLATE = {
+    "layout": {
+        "colorway": ["#636efa", "#EF553B", "#00cc96", "#ab63fa", "#FFA15A"],
+        "font": {"color": "#2a3f5f"},
+        "hovermode": "closest",
+        "paper_bgcolor": "white",
+        "plot_bgcolor": "#E5ECF6",
+        "title": {"x": 0.05},
+        "xaxis": {
+            "automargin": True,
+            "gridcolor": "white",
+            "linecolor": "white",
+            "ticks": "",
+            "title": {"standoff": 15},
+            "zerolinecolor": "white",
+            "zerolinewidth": 2,
+        },
+        "yaxis": {
+            "automargin": True,
+            "gridcolor": "white",
+            "linecolor": "white",
+            "ticks": "",
+            "title": {"standoff": 15},
+            "zerolinecolor": "white",
+            "zerolinewidth": 2,
+        },
+    }
+}
+
+MATERIALITY_LABEL = "Materiality of child rights issues"
+DUE_DILIGENCE_LABEL = "Quality of due diligence"
+
+MATRIX_LAYOUT = {
+    "template": TEMPLATE,
+    "margin": {"t": 60},
+    "showlegend": False,
+    "xaxis": {"range": [0, 4], "title": {"text": MATERIALITY_LABEL}},
+    "yaxis": {"range": [0, 4], "title": {"text": DUE_DILIGENCE_LABEL}},
+    "shapes": [
+        {
+            "type": "line",
+            "xref": "x domain",
+            "yref": "y",
+            "x0": 0,
+            "x1": 1,
+            "y0": 2,
+            "y1": 2,
+        },
+        {
+            "type": "line",
+            "xref": "x",
+            "yref": "y domain",
+            "x0": 2,
+            "x1": 2,
+            "y0": 0,
+            "y1": 1,
+        },
+    ],
+}
+
+BAR_LAYOUT = {
+    "template": TEMPLATE,
+    "barmode": "group",
+    "title": {"text": "Due diligence of material issues"},
+    "legend": {"title": {"text": "variable"}},
+    "xaxis": {"title": {"text": "Issue"}},
+    "yaxis": {"title": {"text": "value"}},
+}
+
+
+def _values(scores):
+    """Plain floats rounded for display; NaN becomes a gap (null)."""
+    return [
+        None if np.isnan(score) else round(float(score), 3)
+        for score in np.asarray(scores, dtype=float)
+    ]
+
+
+def matrix_figure(issues, materiality, due_diligence):
+    return {
+        "data": [
+            {
+                "type": "scatter",
+                "mode": "markers+text",
+                "x": _values(materiality),
+                "y": _values(due_diligence),
+                "text": list(issues),
+                "textposition": "bottom right",
+                "marker": {"color": "#636efa"},
+                "hovertemplate": f"{MATERIALITY_LABEL}=%{{x}}<br>"
+                f"{DUE_DILIGENCE_LABEL}=%{{y}}<br>Issue=%{{text}}<extra></extra>",
+            }
+        ],
+        "layout": MATRIX_LAYOUT,
+    }
+
+
+def bar_figure(issues, materiality, due_diligence):
+    issues = list(issues)
+    return {
+        "data": [
+            {
+                "type": "bar",
+                "name": name,
+                "x": issues,
+                "y": _values(scores),
+                "hovertemplate": f"variable={name}<br>Issue=%{{x}}<br>"
+                "value=%{y}<extra></extra>",
+            }
+            for name, scores in [
+                ("Materiality", materiality),
+                ("Due diligence", due_diligence),
+            ]
+        ],
+        "layout": BAR_LAYOUT,
+    }
+
+
+CHOROPLETH_LAYOUT = {
+    "template": TEMPLATE,
+    "margin": {"t": 30, "b": 0, "l": 0, "r": 0},
+    "geo": {"showframe": False, "projection": {"type": "natural earth"}},
+    "coloraxis": {
+        "colorscale": plotly.colors.sequential.Plasma,
+        "colorbar": {"title": {"text": "Index score"}},
+    },
+    "showlegend": False,
+}
+
+
+def choropleth_traces(store):
+    """The base map trace for every issue in a CountryRiskStore."""
+    traces = {}
+    for issue, column in store.issue_index.items():
+        scores = store.scores[:, column]
+        present = ~np.isnan(scores)
+        traces[issue] = {
+            "type": "choropleth",
+            "locations": store.countries[present].tolist(),
+            "z": _values(scores[present]),
+            "coloraxis": "coloraxis",
+            "hovertemplate": f"<b>%{{location}}</b><br>{issue}=%{{z}}<extra></extra>",
+        }
+    return traces
+
+
+def highlight_trace(countries):
+    """An outline around the selected countries, drawn over the base map."""
+    return {
+        "type": "choropleth",
+        "locations": list(countries),
+        "z": [0] * len(countries),
+        "colorscale": [[0, "rgba(0,0,0,0)"], [1, "rgba(0,0,0,0)"]],
+        "showscale": False,
+        "marker": {"line": {"color": "#00aeef", "width": 2}},
+        "hoverinfo": "skip",
+    }
+
+
+def choropleth_figure(base, countries=()):
+    data = [base]
+    if countries:
+        data.append(highlight_trace(countries))
+    return {"data": data, "layout": CHOROPLETH_LAYOUT}
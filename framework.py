@@ -0,0 +1,205 @@
+"""Loading of the assessment framework workbook.
+
+Parsing the "All" sheet through openpyxl is the slowest part of start up, so
+the parsed table is compiled once into a snapshot keyed by the content hash of
+the workbook. Later starts (and every gunicorn worker) load the snapshot
+instead of the workbook.
+
+The snapshot splits the sheet in two. The fields scoring uses (reference,
+Assessment, Issue and whether a question has a supply chain scope) are small
+integer arrays. The display text of the questions is one UTF-8 blob that is
+memory-mapped, so workers share its pages and only read the questions they
+render.
+"""
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+FRAMEWORK_PATH = "UNICEF_framework_V09.xlsx"
+FRAMEWORK_SHEET = "All"
+CACHE_DIR = os.environ.get("FRAMEWORK_CACHE_DIR", ".framework_cache")
+
+# Bump when the shape of the compiled snapshot changes.
+CACHE_VERSION = 3
+
+# Display text kept out of memory until a question is rendered.
+TEXT_COLUMNS = ["Question number", "Question", "Information", "Answer options"]
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for block in iter(lambda: source.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def split_answer_options(options):
+    return [
+        (option.split("=")[0].strip(), int(option.split("=")[1].strip()))
+        for option in options.splitlines()
+        if option
+    ]
+
+
+def split_question(question):
+    return question.splitlines()
+
+
+def parse_framework(path=FRAMEWORK_PATH, sheet_name=FRAMEWORK_SHEET):
+    data = pd.read_excel(path, sheet_name=sheet_name, skiprows=2)
+    data = data.set_index("Reference")
+    return data
+
+
+def _codes(values):
+    """Categories in order of first appearance, and each value's code (-1 for NaN)."""
+    codes, categories = pd.factorize(pd.Series(values, dtype=object))
+    return np.asarray(categories, dtype=str), codes.astype(np.int16)
+
+
+class Framework:
+    def __init__(self, digest, arrays, text):
+        self.digest = digest
+        self.references = arrays["references"]
+        self.assessments = arrays["assessments"]
+        self.assessment_codes = arrays["assessment_codes"]
+        self.issues = arrays["issues"]
+        self.issue_codes = arrays["issue_codes"]
+        self.supply_chain = arrays["supply_chain"]
+        self.text_offsets = arrays["text_offsets"]
+        self.text = text
+
+    @classmethod
+    def from_frame(cls, data, digest):
+        assessments, assessment_codes = _codes(data["Assessment"])
+        issues, issue_codes = _codes(data["Issue"])
+        # Every text cell of every row, row by row; offsets[i]:offsets[i + 1]
+        # slices cell i out of the blob.
+        cells = [
+            str(value).encode()
+            for row in data[TEXT_COLUMNS].itertuples(index=False)
+            for value in row
+        ]
+        offsets = np.zeros(len(cells) + 1, dtype=np.int64)
+        np.cumsum([len(cell) for cell in cells], out=offsets[1:])
+        arrays = {
+            "references": data.index.to_numpy(dtype=np.int64),
+            "assessments": assessments,
+            "assessment_codes": assessment_codes,
+            "issues": issues,
+            "issue_codes": issue_codes,
+            "supply_chain": data["Supply chain"].notna().to_numpy(),
+            "text_offsets": offsets,
+        }
+        return cls(digest, arrays, np.frombuffer(b"".join(cells), dtype=np.uint8))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(f"{path}.npz") as arrays:
+            arrays = {name: arrays[name] for name in arrays.files}
+        digest = str(arrays.pop("digest"))
+        return cls(digest, arrays, np.load(f"{path}.text.npy", mmap_mode="r"))
+
+    def save(self, path):
+        # Write to private files first so concurrent workers never read a
+        # partially written snapshot. The arrays go last: once they exist,
+        # so does the text.
+        partial = f"{path}.{os.getpid()}.tmp"
+        np.save(f"{partial}.text.npy", np.asarray(self.text))
+        os.replace(f"{partial}.text.npy", f"{path}.text.npy")
+        np.savez(
+            f"{partial}.npz",
+            digest=self.digest,
+            references=self.references,
+            assessments=self.assessments,
+            assessment_codes=self.assessment_codes,
+            issues=self.issues,
+            issue_codes=self.issue_codes,
+            supply_chain=self.supply_chain,
+            text_offsets=self.text_offsets,
+        )
+        os.replace(f"{partial}.npz", f"{path}.npz")
+
+    def __len__(self):
+        return len(self.references)
+
+    def assessment(self, row):
+        code = self.assessment_codes[row]
+        return str(self.assessments[code]) if code >= 0 else None
+
+    def issue(self, row):
+        code = self.issue_codes[row]
+        return str(self.issues[code]) if code >= 0 else None
+
+    def rows(self, assessment):
+        """Positions of the questions of one assessment, in sheet order."""
+        code = list(self.assessments).index(assessment)
+        return np.flatnonzero(self.assessment_codes == code)
+
+    def text_cell(self, row, column):
+        cell = row * len(TEXT_COLUMNS) + TEXT_COLUMNS.index(column)
+        start, end = self.text_offsets[cell], self.text_offsets[cell + 1]
+        return bytes(self.text[start:end]).decode()
+
+    def validate(self):
+        """Raise ValueError if the app cannot be built from this framework."""
+        problems = []
+        if not len(self):
+            problems.append("no questions")
+        references, counts = np.unique(self.references, return_counts=True)
+        if (counts > 1).any():
+            problems.append(f"repeated references {references[counts > 1].tolist()}")
+        for row in range(len(self)):
+            choices = [value for _, value in self.question(row)["Answer choices"]]
+            if not choices:
+                problems.append(f"no answer options for {self.references[row]}")
+            # Saved answers are int8, with -1 for unanswered.
+            elif not all(0 <= value <= 127 for value in choices):
+                problems.append(
+                    f"answer values out of range for {self.references[row]}"
+                )
+        if problems:
+            raise ValueError(
+                f"invalid framework {self.digest[:16]}: " + "; ".join(problems)
+            )
+
+    def question(self, row):
+        """The display fields of one question, read from the text blob."""
+        return {
+            "Question number": self.text_cell(row, "Question number"),
+            "Question lines": split_question(self.text_cell(row, "Question")),
+            "Information": self.text_cell(row, "Information"),
+            "Answer choices": split_answer_options(
+                self.text_cell(row, "Answer options")
+            ),
+            "Supply chain": bool(self.supply_chain[row]),
+        }
+
+
+def cache_path(digest, sheet_name=FRAMEWORK_SHEET, cache_dir=CACHE_DIR):
+    return os.path.join(
+        cache_dir, f"framework-v{CACHE_VERSION}-{sheet_name}-{digest[:16]}"
+    )
+
+
+def load_framework(
+    path=FRAMEWORK_PATH, sheet_name=FRAMEWORK_SHEET, cache_dir=CACHE_DIR
+):
+    digest = file_digest(path)
+    snapshot = cache_path(digest, sheet_name, cache_dir)
+    try:
+        return Framework.load(snapshot)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    framework = Framework.from_frame(parse_framework(path, sheet_name), digest)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        framework.save(snapshot)
+    except OSError:
+        # A read-only deployment still works, it just parses on every start.
+        pass
+    return framework
@@ -0,0 +1,191 @@
+"""Reload the framework workbook while the app is running.
+
+A FrameworkRegistry holds what the app builds from one version of the
+framework: the scoring tables, the question cards and the frozen layout.
+A thread in each process polls the workbook's size and modification time.
+Once a change has settled for one poll, the thread loads and validates the
+new workbook and builds its version there, off the request path. It then
+swaps the new version in by replacing a single reference.
+
+A request reads `current` once and uses that version throughout, so
+requests in flight finish on the version they started with. The last few
+versions can also be looked up by digest, so pages loaded before a swap
+keep working until they are reloaded.
+
+Workers poll on their own timers, so a page can carry a digest its worker
+has not loaded yet, or one it never held (a worker recycled after a swap
+starts from the master's version). get() builds such a version from the
+compiled snapshot the other worker left in the framework cache.
+"""
+import os
+import re
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+from framework import (
+    CACHE_DIR,
+    FRAMEWORK_PATH,
+    FRAMEWORK_SHEET,
+    Framework,
+    cache_path,
+    load_framework,
+)
+from storage import PerProcess
+
+
+DIGEST = re.compile(r"[0-9a-f]{64}")
+
+
+class FrameworkRegistry:
+    def __init__(
+        self,
+        build,
+        path=FRAMEWORK_PATH,
+        sheet_name=FRAMEWORK_SHEET,
+        cache_dir=CACHE_DIR,
+        interval=5.0,
+        keep=3,
+        on_swap=None,
+    ):
+        """build(framework) makes a version, which has the framework's digest.
+
+        on_swap(version) is called after each swap, in the watching thread.
+        """
+        self.build = build
+        self.path = path
+        self.sheet_name = sheet_name
+        self.cache_dir = cache_dir
+        self.interval = interval
+        self.keep = keep
+        self.on_swap = on_swap
+        self.versions = OrderedDict()
+        self.reloads = {"succeeded": 0, "failed": 0}
+        self.lock = threading.Lock()
+        self.building = threading.Lock()
+        self.watcher = PerProcess(self._start_thread)
+        self.seen = self.loaded = self._stat()
+        framework = load_framework(path, sheet_name, cache_dir)
+        framework.validate()
+        self._current = None
+        self._install(build(framework))
+        # Watch from the moment a worker is forked, not its first request.
+        os.register_at_fork(after_in_child=self._watch_in_child)
+
+    @property
+    def current(self):
+        self._start_watcher()
+        return self._current
+
+    def get(self, digest):
+        """A version by its framework digest, or None if it cannot be had.
+
+        A digest this process does not hold is built from its compiled
+        snapshot, if there is one, without making it current.
+        """
+        self._start_watcher()
+        with self.lock:
+            version = self.versions.get(digest)
+        if version is not None or not isinstance(digest, str):
+            return version
+        if not DIGEST.fullmatch(digest):
+            return None
+        with self.building:
+            with self.lock:
+                version = self.versions.get(digest)
+            if version is not None:
+                return version
+            try:
+                framework = Framework.load(
+                    cache_path(digest, self.sheet_name, self.cache_dir)
+                )
+            except (OSError, ValueError, KeyError):
+                return None
+            if framework.digest != digest:
+                return None
+            version = self.build(framework)
+            with self.lock:
+                self._keep(version)
+            return version
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def check(self):
+        """Swap in the workbook if it changed and has settled; True if swapped."""
+        stat = self._stat()
+        if stat != self.seen:
+            # Still being written, perhaps: look again next time.
+            self.seen = stat
+            return False
+        if stat is None or stat == self.loaded:
+            return False
+        self.loaded = stat
+        framework = load_framework(self.path, self.sheet_name, self.cache_dir)
+        if framework.digest == self._current.digest:
+            return False
+        with self.lock:
+            version = self.versions.get(framework.digest)
+        if version is None:
+            framework.validate()
+            version = self.build(framework)
+        self._install(version)
+        return True
+
+    def _install(self, version):
+        with self.lock:
+            self._current = version
+            self._keep(version)
+        if self.on_swap is not None:
+            self.on_swap(version)
+
+    def _keep(self, version):
+        self.versions[version.digest] = version
+        self.versions.move_to_end(version.digest)
+        # The current version is never the one evicted.
+        self.versions.move_to_end(self._current.digest)
+        while len(self.versions) > self.keep:
+            self.versions.popitem(last=False)
+
+    def _watch_in_child(self):
+        self.lock = threading.Lock()
+        self.building = threading.Lock()
+        if self.interval > 0:
+            # The workbook may have changed since the master loaded it, and
+            # the other workers may have swapped already: look now.
+            self.seen = self._stat()
+            self.loaded = None
+            self._check()
+        self._start_watcher()
+
+    def _start_watcher(self):
+        if self.interval > 0:
+            self.watcher.get()
+
+    def _start_thread(self):
+        thread = threading.Thread(
+            target=self._watch, name="framework-watcher", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            self._check()
+
+    def _check(self):
+        try:
+            swapped = self.check()
+        except Exception:
+            # Keep serving the current version; a fixed workbook is
+            # picked up on its next change.
+            self.reloads["failed"] += 1
+            traceback.print_exc()
+        else:
+            self.reloads["succeeded"] += swapped
@@ -0,0 +1,222 @@
+"""A small SQLite-backed queue for reports too slow to build in a request.
+
+Jobs are keyed by what they compute (the report cache key), so submitting a
+job that is already queued, running or finished returns the existing one
+instead of starting another. State, progress and results live in SQLite, so
+any gunicorn worker can answer a poll or a cancel for a job another worker is
+running. Each process runs its jobs on a few threads of its own.
+
+Everyone waiting for a job is recorded as one of its subscribers (e.g. a
+browser session). Cancelling detaches only the caller; the job itself is
+cancelled once nobody is left waiting for it.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from framework import CACHE_DIR
+from storage import Database, PerProcess
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """What a running job function sees: report progress, notice cancellation."""
+
+    def __init__(self, queue, key):
+        self.queue = queue
+        self.key = key
+
+    def progress(self, fraction, message=""):
+        """Record progress, raising JobCancelled if the job was cancelled."""
+        updated = self.queue.execute(
+            "UPDATE jobs SET progress = ?, message = ?, updated = ? "
+            "WHERE key = ? AND state = ?",
+            (fraction, message, time.time(), self.key, RUNNING),
+        ).rowcount
+        if not updated:
+            raise JobCancelled(self.key)
+
+
+class JobQueue:
+    def __init__(self, path, workers=2, ttl=600, stale=120):
+        self.path = path
+        self.workers = workers
+        self.ttl = ttl
+        # A running job not heard from in this long is assumed lost with its
+        # worker and may be submitted again.
+        self.stale = stale
+        self.database = Database(
+            path,
+            [
+                "CREATE TABLE IF NOT EXISTS jobs (key TEXT PRIMARY KEY, "
+                "state TEXT NOT NULL, progress REAL NOT NULL, message TEXT, "
+                "result BLOB, created REAL NOT NULL, updated REAL NOT NULL)",
+                "CREATE TABLE IF NOT EXISTS job_subscribers (key TEXT NOT NULL, "
+                "subscriber TEXT NOT NULL, PRIMARY KEY (key, subscriber))",
+            ],
+        )
+        self.executor = PerProcess(
+            lambda: ThreadPoolExecutor(self.workers, thread_name_prefix="report-job")
+        )
+        # Notified whenever a job run by this process finishes.
+        self.finished = threading.Condition()
+
+    def execute(self, sql, parameters=()):
+        return self.database.connection().execute(sql, parameters)
+
+    def submit(self, key, function, *args, subscriber=None):
+        """Run function(job, *args) in the background unless key is already live.
+
+        The function returns the job's result as a string (e.g. JSON).
+        subscriber, if given, is added to the job's subscribers.
+        """
+        now = time.time()
+        connection = self.database.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("DELETE FROM jobs WHERE updated < ?", (now - self.ttl,))
+            connection.execute(
+                "DELETE FROM job_subscribers WHERE key NOT IN (SELECT key FROM jobs)"
+            )
+            row = connection.execute(
+                "SELECT state, updated FROM jobs WHERE key = ?", (key,)
+            ).fetchone()
+            live = row is not None and (
+                row[0] == DONE
+                or (row[0] in (QUEUED, RUNNING) and row[1] >= now - self.stale)
+            )
+            if not live:
+                connection.execute(
+                    "INSERT OR REPLACE INTO jobs "
+                    "(key, state, progress, message, result, created, updated) "
+                    "VALUES (?, ?, 0, '', NULL, ?, ?)",
+                    (key, QUEUED, now, now),
+                )
+                connection.execute("DELETE FROM job_subscribers WHERE key = ?", (key,))
+            if subscriber is not None:
+                connection.execute(
+                    "INSERT OR IGNORE INTO job_subscribers (key, subscriber) "
+                    "VALUES (?, ?)",
+                    (key, subscriber),
+                )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        if not live:
+            self.executor.get().submit(self.run, key, function, args)
+        return key
+
+    def run(self, key, function, args):
+        started = self.execute(
+            "UPDATE jobs SET state = ?, updated = ? WHERE key = ? AND state = ?",
+            (RUNNING, time.time(), key, QUEUED),
+        ).rowcount
+        if not started:
+            return
+        try:
+            result = function(Job(self, key), *args)
+        except JobCancelled:
+            return
+        except Exception as error:
+            state, result, message = FAILED, None, f"{type(error).__name__}: {error}"
+        else:
+            state, message = DONE, ""
+        self.execute(
+            "UPDATE jobs SET state = ?, progress = 1, message = ?, result = ?, "
+            "updated = ? WHERE key = ? AND state = ?",
+            (state, message, result, time.time(), key, RUNNING),
+        )
+        with self.finished:
+            self.finished.notify_all()
+
+    def status(self, key, subscriber=None):
+        """The job's state, progress, message and result, or None if unknown.
+
+        A subscriber who cancelled sees the job as cancelled while it runs on
+        for others.
+        """
+        row = self.execute(
+            "SELECT state, progress, message, result, "
+            "EXISTS (SELECT 1 FROM job_subscribers WHERE key = ? AND subscriber = ?) "
+            "FROM jobs WHERE key = ?",
+            (key, subscriber, key),
+        ).fetchone()
+        if row is None:
+            return None
+        *fields, subscribed = row
+        status = dict(zip(["state", "progress", "message", "result"], fields))
+        detached = subscriber is not None and not subscribed
+        if detached and status["state"] in (QUEUED, RUNNING):
+            status["state"] = CANCELLED
+        return status
+
+    def wait(self, key, timeout, subscriber=None):
+        """The job's status once it is no longer queued or running, or after timeout.
+
+        A job run by this process wakes its waiters as it finishes; one run by
+        another worker is looked for every few milliseconds.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            status = self.status(key, subscriber)
+            remaining = deadline - time.monotonic()
+            finished = status is None or status["state"] not in (QUEUED, RUNNING)
+            if finished or remaining <= 0:
+                return status
+            with self.finished:
+                self.finished.wait(min(remaining, 0.01))
+
+    def cancel(self, key, subscriber=None):
+        """Stop waiting for a job, cancelling it if no subscriber is left.
+
+        Without a subscriber the job is cancelled outright. A running job
+        stops at its next progress. True if the job was cancelled.
+        """
+        connection = self.database.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if subscriber is not None:
+                connection.execute(
+                    "DELETE FROM job_subscribers WHERE key = ? AND subscriber = ?",
+                    (key, subscriber),
+                )
+                (waiting,) = connection.execute(
+                    "SELECT COUNT(*) FROM job_subscribers WHERE key = ?", (key,)
+                ).fetchone()
+            cancelled = False
+            if subscriber is None or not waiting:
+                cancelled = bool(
+                    connection.execute(
+                        "UPDATE jobs SET state = ?, updated = ? "
+                        "WHERE key = ? AND state IN (?, ?)",
+                        (CANCELLED, time.time(), key, QUEUED, RUNNING),
+                    ).rowcount
+                )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return cancelled
+
+
+def from_environment():
+    path = os.environ.get("JOB_QUEUE_PATH")
+    if path is None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        path = os.path.join(CACHE_DIR, "jobs.sqlite")
+    return JobQueue(
+        path,
+        workers=int(os.environ.get("JOB_WORKERS", 2)),
+        ttl=float(os.environ.get("JOB_TTL", 600)),
+    )
@@ -0,0 +1,286 @@
+"""Latency and payload metrics for the Dash callbacks, in Prometheus text format.
+
+Every /_dash-update-component request is timed end to end, including the
+JSON serialisation of the response, and its response size recorded, labelled
+by callback. Callbacks can also time their own stages with a Timer, whose
+labels (e.g. the report's button_id) are added to the request's metrics.
+
+    GET  /metrics                 histograms and report cache counters
+    GET  /metrics/profile         cumulative profile of the sampled callbacks
+    POST /metrics/profile?rate=R  profile a fraction R of calls (0 turns it off)
+
+If METRICS_TOKEN is set, these endpoints require "Authorization: Bearer <token>".
+Without it they only answer requests made directly from this host, as the
+profile shows source paths, and the sample rate can only be set at start up
+(PROFILE_SAMPLE_RATE).
+"""
+import cProfile
+import functools
+import io
+import os
+import pstats
+import random
+import threading
+import time
+
+import flask
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+BYTES_BUCKETS = (1000, 4000, 16000, 64000, 256000, 1000000, 4000000)
+
+LOCAL_ADDRESSES = {"127.0.0.1", "::1"}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(f'{name}="{_escape(value)}"' for name, value in labels)
+
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> [count, sum, one cumulative count per bucket]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.setdefault(key, [0, 0.0] + [0] * len(self.buckets))
+            series[0] += 1
+            series[1] += value
+            for index, bound in enumerate(self.buckets, 2):
+                if value <= bound:
+                    series[index] += 1
+
+    def render(self):
+        with self.lock:
+            series = {key: list(values) for key, values in self.series.items()}
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (count, total, *buckets) in sorted(series.items()):
+            for bound, bucket in zip(self.buckets + ("+Inf",), buckets + [count]):
+                labels = _format_labels(key + (("le", bound),))
+                lines.append(f"{self.name}_bucket{labels} {bucket}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class Gauge:
+    """A metric read from collect(), a dict of labels to value, when scraped."""
+
+    def __init__(self, name, help, collect, type="gauge"):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.type = type
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for labels, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name, help, buckets=SECONDS_BUCKETS):
+        histogram = Histogram(name, help, buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def gauge(self, name, help, collect, type="gauge"):
+        gauge = Gauge(name, help, collect, type)
+        self.metrics.append(gauge)
+        return gauge
+
+    def render(self):
+        return "\n".join(line for metric in self.metrics for line in metric.render())
+
+
+REGISTRY = Registry()
+REQUEST_SECONDS = REGISTRY.histogram(
+    "assessment_callback_seconds",
+    "Time to answer a callback request, including serialisation.",
+)
+RESPONSE_BYTES = REGISTRY.histogram(
+    "assessment_callback_response_bytes",
+    "Size of callback responses before compression.",
+    BYTES_BUCKETS,
+)
+STAGE_SECONDS = REGISTRY.histogram(
+    "assessment_callback_stage_seconds", "Time spent in each stage of a callback."
+)
+
+
+class Timer:
+    """Times consecutive stages of one callback call.
+
+    Each lap() records the time since the previous lap (or since the timer
+    was created) as the named stage.
+    """
+
+    def __init__(self, callback, **labels):
+        self.labels = dict(labels, callback=callback)
+        self.last = time.perf_counter()
+        if flask.has_request_context():
+            flask.g.metric_labels = labels
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        STAGE_SECONDS.observe(now - self.last, stage=stage, **self.labels)
+        self.last = now
+
+
+class Profiler:
+    """Profiles a random sample of calls into one cumulative pstats report.
+
+    cProfile can only profile one call at a time, so a sampled call that
+    overlaps another profiled call on a different thread runs unprofiled.
+    """
+
+    def __init__(self, rate=0.0):
+        self.rate = rate
+        self.samples = 0
+        self.stats = None
+        self.busy = threading.Lock()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        if not 0 <= rate <= 1:
+            raise ValueError("profile rate must be between 0 and 1")
+        self.rate = rate
+
+    def reset(self):
+        with self.lock:
+            self.samples = 0
+            self.stats = None
+
+    def call(self, function, *args, **kwargs):
+        if not (self.rate and random.random() < self.rate):
+            return function(*args, **kwargs)
+        if not self.busy.acquire(blocking=False):
+            return function(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            self.busy.release()
+            with self.lock:
+                self.samples += 1
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    def report(self, limit=40):
+        output = io.StringIO()
+        with self.lock:
+            output.write(f"{self.samples} sampled calls at rate {self.rate}\n")
+            if self.stats is not None:
+                self.stats.stream = output
+                self.stats.sort_stats("cumulative").print_stats(limit)
+        return output.getvalue()
+
+
+PROFILER = Profiler(float(os.environ.get("PROFILE_SAMPLE_RATE", 0)))
+
+
+def profiled(function):
+    """Let the sampled profiler see calls to a callback."""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return PROFILER.call(function, *args, **kwargs)
+
+    return wrapper
+
+
+def _authorized():
+    token = os.environ.get("METRICS_TOKEN")
+    if token:
+        return flask.request.headers.get("Authorization") == f"Bearer {token}"
+    # A proxy on this host relays other hosts' requests from a local address.
+    return (
+        flask.request.remote_addr in LOCAL_ADDRESSES
+        and "X-Forwarded-For" not in flask.request.headers
+    )
+
+
+def instrument(app, reports=None):
+    """Time every callback request of a Dash app and serve /metrics from it."""
+    server = app.server
+
+    if reports is not None:
+        REGISTRY.gauge(
+            "assessment_report_cache_entries",
+            "Reports held in this process's cache.",
+            lambda: {(): reports.stats()["size"]},
+        )
+        REGISTRY.gauge(
+            "assessment_report_cache_requests_total",
+            "Report cache lookups by result.",
+            lambda: {
+                (("result", result),): count
+                for result, count in reports.stats().items()
+                if result != "size"
+            },
+            type="counter",
+        )
+
+    @server.before_request
+    def start_timer():
+        flask.g.metric_start = time.perf_counter()
+
+    @server.after_request
+    def record_callback(response):
+        start = flask.g.pop("metric_start", None)
+        if start is None or not flask.request.path.endswith("/_dash-update-component"):
+            return response
+        body = flask.request.get_json(silent=True) or {}
+        callback = app.callback_map.get(body.get("output"), {}).get("callback")
+        labels = dict(
+            flask.g.get("metric_labels", {}),
+            callback=getattr(callback, "__name__", "unknown"),
+            status=response.status_code,
+        )
+        REQUEST_SECONDS.observe(time.perf_counter() - start, **labels)
+        if not response.direct_passthrough:
+            RESPONSE_BYTES.observe(response.calculate_content_length() or 0, **labels)
+        return response
+
+    @server.route("/metrics")
+    def metrics():
+        if not _authorized():
+            flask.abort(401)
+        return flask.Response(
+            REGISTRY.render() + "\n", mimetype="text/plain; version=0.0.4"
+        )
+
+    @server.route("/metrics/profile", methods=["GET", "POST"])
+    def profile():
+        if not _authorized():
+            flask.abort(401)
+        if flask.request.method == "POST":
+            if not os.environ.get("METRICS_TOKEN"):
+                return flask.Response(
+                    "set METRICS_TOKEN to change the profile rate\n",
+                    status=403,
+                    mimetype="text/plain",
+                )
+            try:
+                PROFILER.set_rate(float(flask.request.values.get("rate", 0)))
+            except ValueError as error:
+                return flask.Response(f"{error}\n", status=400, mimetype="text/plain")
+            if "reset" in flask.request.values:
+                PROFILER.reset()
+        return flask.Response(PROFILER.report(), mimetype="text/plain")
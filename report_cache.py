@@ -0,0 +1,142 @@
+"""Cache of rendered reports keyed by the answers that produced them.
+
+Reports are stored as their JSON-ready form (what Dash would send to the
+browser), so they can be shared between gunicorn workers through an optional
+SQLite backend as well as held in a per-process LRU.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import plotly
+
+from storage import Database
+
+
+def to_json(value):
+    return json.dumps(value, cls=plotly.utils.PlotlyJSONEncoder)
+
+
+class SQLiteBackend:
+    def __init__(self, path):
+        self.path = path
+        self.database = Database(
+            path,
+            [
+                "CREATE TABLE IF NOT EXISTS reports "
+                "(key TEXT PRIMARY KEY, created REAL NOT NULL, value BLOB NOT NULL)"
+            ],
+        )
+
+    def get(self, key, ttl):
+        row = (
+            self.database.connection()
+            .execute(
+                "SELECT value FROM reports WHERE key = ? AND created >= ?",
+                (key, time.time() - ttl),
+            )
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def set(self, key, value, ttl):
+        connection = self.database.connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO reports (key, created, value) VALUES (?, ?, ?)",
+            (key, time.time(), value),
+        )
+        connection.execute(
+            "DELETE FROM reports WHERE created < ?", (time.time() - ttl,)
+        )
+
+
+class ReportCache:
+    def __init__(self, maxsize=256, ttl=600, backend=None, namespace=""):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = backend
+        self.namespace = namespace
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def key(self, answers, button_id, countries=(), namespace=None):
+        """Hash an aligned answer vector with the request that renders it.
+
+        namespace, if given, is used instead of the cache's own (e.g. the
+        digest of the framework version the answers belong to).
+        """
+        namespace = self.namespace if namespace is None else namespace
+        digest = hashlib.sha256(namespace.encode())
+        digest.update(np.asarray(answers, dtype=np.int16).tobytes())
+        digest.update(
+            json.dumps(
+                [button_id, [sorted(group or []) for group in countries]]
+            ).encode()
+        )
+        return digest.hexdigest()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.entries.pop(key, None)
+
+        if self.backend is not None:
+            shared = self.backend.get(key, self.ttl)
+            if shared is not None:
+                value = json.loads(shared)
+                self._remember(key, value)
+                with self.lock:
+                    self.shared_hits += 1
+                return value
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        encoded = to_json(value)
+        # Keep the decoded JSON rather than the components themselves so that
+        # local and shared hits return exactly the same thing.
+        value = json.loads(encoded)
+        self._remember(key, value)
+        if self.backend is not None:
+            self.backend.set(key, encoded, self.ttl)
+        return value
+
+    def _remember(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+            }
+
+
+def from_environment(namespace=""):
+    path = os.environ.get("REPORT_CACHE_PATH")
+    return ReportCache(
+        maxsize=int(os.environ.get("REPORT_CACHE_SIZE", 256)),
+        ttl=float(os.environ.get("REPORT_CACHE_TTL", 600)),
+        backend=SQLiteBackend(path) if path else None,
+        namespace=namespace,
+    )
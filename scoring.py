@@ -0,0 +1,530 @@
+"""Vectorised scoring of survey answers.
+
+The framework fixes which answer slots exist (one per question and scope) and
+which (Issue, Scope, Assessment) group each slot counts towards, so all of the
+grouping and joining is done once when a ScoringModel is built. Scoring an
+answer vector is then a matrix product followed by a few gathers.
+"""
+import math
+import threading
+from collections import OrderedDict
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+
+from framework import split_answer_options
+
+SCOPES = ["Business", "Supply Chain"]
+
+# Marks a slot without an answer in an encoded answer vector.
+UNANSWERED = -1
+
+MATERIALITY_BINS = ([2, 4], ["High Risk", "Medium Risk", "Low Risk"])
+RATING_BINS = ([1, 2, 3], ["Weak", "Moderate", "Good", "Strong"])
+PRIORITY_BINS = (
+    [1, 2, 3],
+    ["High priority", "Priority", "Low priority", "Not a priority"],
+)
+
+
+def bin_codes(scores, bins):
+    edges, _ = bins
+    scores = np.asarray(scores, dtype=float)
+    positions = np.digitize(scores, edges)
+    # NaN compares false against every threshold, so it gets the lowest label.
+    positions[np.isnan(scores)] = 0
+    return positions
+
+
+def bin_labels(scores, bins):
+    return np.asarray(bins[1], dtype=object)[bin_codes(scores, bins)]
+
+
+def meterial(scores):
+    return bin_labels(scores, MATERIALITY_BINS)
+
+
+def rating(scores):
+    return bin_labels(scores, RATING_BINS)
+
+
+def priority(scores):
+    return bin_labels(scores, PRIORITY_BINS)
+
+
+def _gather(values, index):
+    """Take columns of a 2-D array, yielding NaN where the index is -1."""
+    if (index >= 0).all():
+        return values[:, index]
+    gathered = values[:, np.maximum(index, 0)].astype(float)
+    gathered[:, index < 0] = np.nan
+    return gathered
+
+
+def _nanmean(stacked, axis):
+    present = ~np.isnan(stacked)
+    count = present.sum(axis=axis)
+    total = np.where(present, stacked, 0).sum(axis=axis)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+
+def _grouped_nanmean(values, membership):
+    """Average the columns of values into groups, skipping NaN like pandas."""
+    values = values.astype(float)
+    present = ~np.isnan(values)
+    total = np.where(present, values, 0) @ membership
+    count = present.astype(float) @ membership
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+
+def _mean_present(values):
+    present = [value for value in values if not math.isnan(value)]
+    return sum(present) / len(present) if present else math.nan
+
+
+def _as_column(values):
+    """Keep integer sums as integers, as the pandas pipeline did."""
+    if values.dtype.kind == "f" and not np.isnan(values).any():
+        if (values == np.round(values)).all():
+            return values.astype(np.int64)
+    return values
+
+
+class ScoringModel:
+    def __init__(self, framework):
+        slots = []
+        for row, reference in enumerate(framework.references):
+            slots.append((row, reference, "Business"))
+            if framework.supply_chain[row]:
+                slots.append((row, reference, "Supply Chain"))
+
+        self.ids = [f"{reference}-{scope}" for _, reference, scope in slots]
+        self.slot_index = {id: position for position, id in enumerate(self.ids)}
+        # The values each slot's question can be answered with.
+        self.answer_values = [
+            frozenset(
+                value
+                for _, value in split_answer_options(
+                    framework.text_cell(row, "Answer options")
+                )
+            )
+            for row, _, _ in slots
+        ]
+
+        keys = [
+            (framework.issue(row), scope, framework.assessment(row))
+            for row, _, scope in slots
+        ]
+        groups = sorted({key for key in keys if None not in key})
+        group_index = {key: position for position, key in enumerate(groups)}
+        self.slot_group = np.array([group_index.get(key, -1) for key in keys])
+        self.membership = np.zeros((len(self.ids), len(groups)))
+        valid = self.slot_group >= 0
+        self.membership[np.flatnonzero(valid), self.slot_group[valid]] = 1
+
+        self.group_issue = np.array([issue for issue, _, _ in groups], dtype=object)
+        self.group_scope = np.array([scope for _, scope, _ in groups], dtype=object)
+        self.group_assessment = np.array(
+            [assessment for _, _, assessment in groups], dtype=object
+        )
+        self.materiality_groups = np.flatnonzero(self.group_assessment == "Materiality")
+        self.due_diligence_groups = np.flatnonzero(
+            self.group_assessment == "Due diligence"
+        )
+        self.mitigation_groups = np.flatnonzero(self.group_assessment == "Mitigation")
+
+        # Rows of the outer join of materiality and mitigation on Issue; each
+        # row points at a materiality group and a mitigation group (or -1).
+        row_materiality, row_mitigation, row_issue = [], [], []
+        issues = sorted(
+            set(self.group_issue[self.materiality_groups])
+            | set(self.group_issue[self.mitigation_groups])
+        )
+        for issue in issues:
+            left = [g for g in self.materiality_groups if self.group_issue[g] == issue]
+            right = [g for g in self.mitigation_groups if self.group_issue[g] == issue]
+            for materiality_group in left or [-1]:
+                for mitigation_group in right or [-1]:
+                    row_materiality.append(materiality_group)
+                    row_mitigation.append(mitigation_group)
+                    row_issue.append(issue)
+        self.row_materiality = np.array(row_materiality, dtype=int)
+        self.row_mitigation = np.array(row_mitigation, dtype=int)
+        self.row_issue = np.array(row_issue, dtype=object)
+        self.row_scope = np.array(
+            [
+                self.group_scope[group] if group >= 0 else np.nan
+                for group in self.row_materiality
+            ],
+            dtype=object,
+        )
+
+        # Business and supply chain rows are averaged per Issue for the
+        # "Combined" scope.
+        scoped = np.isin(self.row_scope, SCOPES)
+        self.combined_issues = np.array(
+            sorted(set(self.row_issue[scoped])), dtype=object
+        )
+        combined_index = {
+            issue: position for position, issue in enumerate(self.combined_issues)
+        }
+        self.combined_membership = np.zeros(
+            (len(self.row_issue), len(self.combined_issues))
+        )
+        for row in np.flatnonzero(scoped):
+            self.combined_membership[row, combined_index[self.row_issue[row]]] = 1
+        # The (materiality, mitigation) groups of each issue's scoped rows.
+        self.issue_groups = {
+            issue: [
+                (self.row_materiality[row], self.row_mitigation[row])
+                for row in np.flatnonzero(scoped & (self.row_issue == issue))
+            ]
+            for issue in self.combined_issues
+        }
+        # Issues whose combined scores use the mean due diligence score.
+        self.mitigated_issues = [
+            issue
+            for issue, groups in self.issue_groups.items()
+            if any(mitigation >= 0 for _, mitigation in groups)
+        ]
+
+    def answer_vector(self, ids, values):
+        """Align (id, value) pairs to the slot order; unanswered slots score 0."""
+        answers = np.zeros(len(self.ids))
+        for id, value in zip(ids, values):
+            position = self.slot_index.get(id)
+            if position is not None and value:
+                answers[position] = value
+        return answers
+
+    def checked_changes(self, changes):
+        """(slot, value) pairs sent by a browser, with None for a cleared answer.
+
+        Raises ValueError unless every slot is one of the model's and every
+        value is one of its question's answer values or UNANSWERED.
+        """
+        try:
+            changes = [(slot, value) for slot, value in changes]
+        except (TypeError, ValueError):
+            raise ValueError("expected a list of (slot, value) pairs")
+        checked = []
+        for slot, value in changes:
+            # bool is an int too, but no browser sends one for a slot.
+            if type(slot) is not int or not 0 <= slot < len(self.ids):
+                raise ValueError(f"no answer slot {slot!r}")
+            if value is None:
+                value = UNANSWERED
+            if type(value) is not int or (
+                value != UNANSWERED and value not in self.answer_values[slot]
+            ):
+                raise ValueError(f"{value!r} is not an answer to {self.ids[slot]}")
+            checked.append((slot, value))
+        return checked
+
+    def decode_answers(self, encoded):
+        """Turn an encoded answer vector (UNANSWERED for blanks) into scores."""
+        answers = np.asarray(encoded, dtype=float)
+        if answers.shape != (len(self.ids),):
+            raise ValueError(
+                f"expected {len(self.ids)} encoded answers, got {answers.shape}"
+            )
+        return np.where(answers == UNANSWERED, 0, answers)
+
+    def group_sums(self, answers):
+        return np.atleast_2d(answers) @ self.membership
+
+    def mitigation_combined(self, sums):
+        """Mitigation scores averaged with the mean due diligence score."""
+        with np.errstate(invalid="ignore"):
+            due_diligence_average = sums[:, self.due_diligence_groups].mean(axis=1)
+        group_combined = np.full(sums.shape, np.nan)
+        group_combined[:, self.mitigation_groups] = (
+            sums[:, self.mitigation_groups] + due_diligence_average[:, None]
+        ) / 2
+        return group_combined
+
+    def join_rows(self, sums, group_combined):
+        row_score = _gather(sums, self.row_materiality)
+        row_combined = _gather(group_combined, self.row_mitigation)
+        return {
+            "row_score": row_score,
+            "row_mitigation_score": _gather(sums, self.row_mitigation),
+            "row_combined": row_combined,
+            "row_priority": _nanmean(
+                np.stack([row_score.astype(float), row_combined]), axis=0
+            ),
+        }
+
+    def combine_scopes(self, rows):
+        return {
+            name: _grouped_nanmean(rows[f"row_{column}"], self.combined_membership)
+            for name, column in [
+                ("Score", "score"),
+                ("combined_score", "combined"),
+                ("priority_score", "priority"),
+            ]
+        }
+
+    def reduce(self, answers):
+        """Score a (respondents x slots) answer matrix into per-row arrays."""
+        sums = self.group_sums(answers)
+        group_combined = self.mitigation_combined(sums)
+        rows = self.join_rows(sums, group_combined)
+        return {
+            "sums": sums,
+            "group_combined": group_combined,
+            **rows,
+            "combined": self.combine_scopes(rows),
+        }
+
+    def score(self, answers):
+        return Scores(self, answers)
+
+
+class ScoringState:
+    """Running scores for one respondent, updated one answer at a time.
+
+    A materiality or mitigation answer moves a single group sum, so only its
+    issue's combined scores are recomputed, in O(1). A due diligence answer
+    moves the due diligence mean, which every mitigated issue depends on.
+    """
+
+    def __init__(self, model, answers=None):
+        self.model = model
+        self.answers = (
+            np.zeros(len(model.ids)) if answers is None else np.array(answers, float)
+        )
+        self.sums = model.group_sums(self.answers)[0]
+        self.due_diligence_total = self.sums[model.due_diligence_groups].sum()
+        self.combined = {issue: self._combine(issue) for issue in model.combined_issues}
+
+    def due_diligence_mean(self):
+        count = len(self.model.due_diligence_groups)
+        return float(self.due_diligence_total) / count if count else math.nan
+
+    def apply(self, slot, value):
+        """Change one encoded answer; returns the issues whose scores moved."""
+        value = 0 if value is None or value == UNANSWERED else value
+        delta = value - self.answers[slot]
+        group = self.model.slot_group[slot]
+        self.answers[slot] = value
+        if not delta or group < 0:
+            return []
+        self.sums[group] += delta
+        if self.model.group_assessment[group] == "Due diligence":
+            self.due_diligence_total += delta
+            issues = self.model.mitigated_issues
+        elif self.model.group_issue[group] in self.combined:
+            issues = [self.model.group_issue[group]]
+        else:
+            issues = []
+        for issue in issues:
+            self.combined[issue] = self._combine(issue)
+        return issues
+
+    def _combine(self, issue):
+        """Score, combined_score and priority_score of an issue's Combined row."""
+        # An issue has a row or two, so plain floats beat numpy here.
+        due_diligence_mean = self.due_diligence_mean()
+        scores, combined, priorities = [], [], []
+        for materiality, mitigation in self.model.issue_groups[issue]:
+            score = float(self.sums[materiality])
+            mitigated = (
+                (float(self.sums[mitigation]) + due_diligence_mean) / 2
+                if mitigation >= 0
+                else math.nan
+            )
+            scores.append(score)
+            combined.append(mitigated)
+            priorities.append(_mean_present([score, mitigated]))
+        return (
+            _mean_present(scores),
+            _mean_present(combined),
+            _mean_present(priorities),
+        )
+
+    def combined_rows(self):
+        """The Combined scope table, as records in combined_issues order."""
+        scores = np.array(
+            [self.combined[issue] for issue in self.model.combined_issues]
+        )
+        return [
+            {
+                "Issue": issue,
+                "Score": score,
+                "Materiality": materiality,
+                "combined_score": combined_score,
+                "combined_rating": combined_rating,
+                "priority_score": priority_score,
+                "priority": priority_label,
+            }
+            for (
+                issue,
+                (score, combined_score, priority_score),
+                materiality,
+                combined_rating,
+                priority_label,
+            ) in zip(
+                self.model.combined_issues,
+                scores.tolist(),
+                meterial(scores[:, 0]),
+                rating(scores[:, 1]),
+                priority(scores[:, 2]),
+            )
+        ]
+
+
+class ScoringStates:
+    """The ScoringState of each recently active session, least recent evicted.
+
+    A state is brought up to the session's saved answers by applying just
+    the slots that differ, so answers saved from another tab or by another
+    worker are counted too and the live table never drifts from them.
+    """
+
+    def __init__(self, model, maxsize=1024):
+        self.model = model
+        self.maxsize = maxsize
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+
+    def update(self, session, encoded):
+        """The session's state, scoring its encoded answers."""
+        answers = self.model.decode_answers(encoded)
+        with self.lock:
+            state = self.states.pop(session, None)
+            if state is None:
+                state = ScoringState(self.model, answers)
+            else:
+                for slot in np.flatnonzero(state.answers != answers):
+                    state.apply(slot, answers[slot])
+            self.states[session] = state
+            while len(self.states) > self.maxsize:
+                self.states.popitem(last=False)
+            return state
+
+
+class Scores:
+    """The frames the report tables are built from, for a single respondent.
+
+    Every array and frame is computed on first access and kept for the rest
+    of the request, so a callback only pays for the tables it renders.
+    """
+
+    def __init__(self, model, answers):
+        self.model = model
+        self.answers = answers
+
+    @cached_property
+    def sums(self):
+        return self.model.group_sums(self.answers)
+
+    @cached_property
+    def group_combined(self):
+        return self.model.mitigation_combined(self.sums)
+
+    @cached_property
+    def rows(self):
+        return self.model.join_rows(self.sums, self.group_combined)
+
+    @cached_property
+    def meteriality(self):
+        meteriality = self._assessment_frame(self.model.materiality_groups)
+        meteriality["Materiality"] = meterial(meteriality["Score"])
+        return meteriality
+
+    @cached_property
+    def due_diligence(self):
+        due_diligence = self._assessment_frame(self.model.due_diligence_groups)
+        due_diligence["Rating"] = rating(due_diligence["Score"])
+        return due_diligence
+
+    @cached_property
+    def mitigation(self):
+        groups = self.model.mitigation_groups
+        mitigation = self._assessment_frame(groups)
+        mitigation["Rating"] = rating(mitigation["Score"])
+        mitigation["combined_score"] = self.group_combined[0, groups]
+        return mitigation
+
+    @cached_property
+    def meteriality_combined(self):
+        model = self.model
+        rows = {name: column[0] for name, column in self.rows.items()}
+
+        # Columns that came from only one side of the join are missing on
+        # rows where that side had no group.
+        def side(column, groups, rows=False):
+            present = groups >= 0
+            values = np.full(len(groups), np.nan, dtype=object)
+            values[present] = column[present] if rows else column[groups[present]]
+            return values
+
+        return pd.DataFrame(
+            {
+                "Issue": model.row_issue,
+                "Scope": model.row_scope,
+                "Assessment": side(model.group_assessment, model.row_materiality),
+                "Score": _as_column(rows["row_score"]),
+                "Materiality": side(
+                    meterial(rows["row_score"]), model.row_materiality, rows=True
+                ),
+                "Scopemitigation": side(model.group_scope, model.row_mitigation),
+                "Assessmentmitigation": side(
+                    model.group_assessment, model.row_mitigation
+                ),
+                "Scoremitigation": _as_column(rows["row_mitigation_score"]),
+                "Rating": side(
+                    rating(rows["row_mitigation_score"]),
+                    model.row_mitigation,
+                    rows=True,
+                ),
+                "combined_score": rows["row_combined"],
+                "combined_rating": rating(rows["row_combined"]),
+                "priority_score": rows["row_priority"],
+                "priority": priority(rows["row_priority"]),
+            }
+        )
+
+    @cached_property
+    def business_meteriality(self):
+        combined = self.meteriality_combined
+        return combined[combined["Scope"] == "Business"]
+
+    @cached_property
+    def supply_meteriality(self):
+        combined = self.meteriality_combined
+        return combined[combined["Scope"] == "Supply Chain"]
+
+    @cached_property
+    def combined_meteriality(self):
+        combined = {
+            name: column[0]
+            for name, column in self.model.combine_scopes(self.rows).items()
+        }
+        return pd.DataFrame(
+            {
+                "Issue": self.model.combined_issues,
+                "Score": combined["Score"],
+                "combined_score": combined["combined_score"],
+                "priority_score": combined["priority_score"],
+                "Scope": "Combined",
+                "Materiality": meterial(combined["Score"]),
+                "combined_rating": rating(combined["combined_score"]),
+                "priority": priority(combined["priority_score"]),
+            }
+        )
+
+    def _assessment_frame(self, groups):
+        model = self.model
+        return pd.DataFrame(
+            {
+                "Scope": model.group_scope[groups],
+                "Assessment": model.group_assessment[groups],
+                "Score": _as_column(self.sums[0, groups]),
+            },
+            index=pd.Index(model.group_issue[groups], name="Issue"),
+        )
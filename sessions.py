@@ -0,0 +1,160 @@
+"""Respondents' answers kept on the server, keyed by a browser session id.
+
+Each session's answers are one int8 per answer slot, in the scoring model's
+slot order (UNANSWERED for blanks), stored in SQLite in WAL mode. Reads go
+through an in-process LRU; a cached vector is used as long as the database
+holds nothing newer for the session, which costs one primary key lookup.
+
+Several gunicorn workers, and several threads in each, may serve the same
+session. The browser only sends the answers that changed, so each change is
+merged into the saved answers, slot by slot, in the same write transaction
+that reads them: no change is lost to another one saved at the same time.
+
+Each set of slots is saved too, so answers saved against an older version of
+the framework carry over to the slots that still exist in the new one.
+"""
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from scoring import UNANSWERED
+from storage import Database, data_path
+
+SESSION_ID = re.compile(r"[0-9a-f]{32}")
+
+
+def valid_session(session):
+    return isinstance(session, str) and SESSION_ID.fullmatch(session) is not None
+
+
+class SessionStore:
+    def __init__(self, path, slots, cache_size=4096):
+        self.path = path
+        self.slots = len(slots)
+        self.slot_index = {slot: position for position, slot in enumerate(slots)}
+        self.slot_list = "\n".join(slots)
+        self.layout = hashlib.sha256(self.slot_list.encode()).hexdigest()[:16]
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.database = Database(
+            path,
+            [
+                "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, "
+                "layout TEXT NOT NULL, answers BLOB NOT NULL, updated REAL NOT NULL)",
+                "CREATE TABLE IF NOT EXISTS layouts "
+                "(layout TEXT PRIMARY KEY, slots TEXT NOT NULL)",
+                (
+                    "INSERT OR IGNORE INTO layouts (layout, slots) VALUES (?, ?)",
+                    (self.layout, self.slot_list),
+                ),
+            ],
+        )
+
+    def blank(self):
+        return np.full(self.slots, UNANSWERED, dtype=np.int8)
+
+    def answers(self, session):
+        """A copy of the session's encoded answers (all blank if unknown)."""
+        with self.lock:
+            entry = self.cache.get(session)
+        connection = self.database.connection()
+        if entry is not None:
+            row = connection.execute(
+                "SELECT updated FROM sessions WHERE id = ?", (session,)
+            ).fetchone()
+            if row is not None and row[0] == entry[0]:
+                self._remember(session, entry)
+                return entry[1].copy()
+        entry = self._read(connection, session)
+        if entry is None:
+            return self.blank()
+        self._remember(session, entry)
+        return entry[1].copy()
+
+    def apply(self, session, changes):
+        """Set (slot, value) pairs of the session's answers; returns them all."""
+        connection = self.database.connection()
+        # The write lock is taken before reading, so changes saved by other
+        # threads or workers in the meantime are kept.
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            entry = self._read(connection, session)
+            answers = self.blank() if entry is None else entry[1]
+            for slot, value in changes:
+                answers[slot] = UNANSWERED if value is None else value
+            # A new version number, compared for equality by cached copies.
+            updated = 1 if entry is None else entry[0] + 1
+            connection.execute(
+                "INSERT OR REPLACE INTO sessions (id, layout, answers, updated) "
+                "VALUES (?, ?, ?, ?)",
+                (session, self.layout, answers.tobytes(), updated),
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        self._remember(session, (updated, answers))
+        return answers.copy()
+
+    def _read(self, connection, session):
+        """The session's (updated, answers) in this store's slots, or None."""
+        row = connection.execute(
+            "SELECT layout, answers, updated FROM sessions WHERE id = ?", (session,)
+        ).fetchone()
+        if row is None:
+            return None
+        answers = np.frombuffer(row[1], dtype=np.int8).copy()
+        if row[0] != self.layout:
+            answers = self._carry_over(connection, row[0], answers)
+        return (row[2], answers)
+
+    def _carry_over(self, connection, layout, saved):
+        """Answers saved against other slots, moved to the same slots here."""
+        answers = self.blank()
+        row = connection.execute(
+            "SELECT slots FROM layouts WHERE layout = ?", (layout,)
+        ).fetchone()
+        if row is not None:
+            for position, slot in enumerate(row[0].split("\n")):
+                if slot in self.slot_index and position < len(saved):
+                    answers[self.slot_index[slot]] = saved[position]
+        return answers
+
+    def chunks(self, size):
+        """Every saved session's answers, as lists of up to size (id, answers)."""
+        cursor = self.database.connection().execute(
+            "SELECT id, answers FROM sessions WHERE layout = ?", (self.layout,)
+        )
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                return
+            yield [
+                (session, np.frombuffer(answers, dtype=np.int8))
+                for session, answers in rows
+            ]
+
+    def _remember(self, session, entry):
+        if not self.cache_size:
+            return
+        with self.lock:
+            self.cache[session] = entry
+            self.cache.move_to_end(session)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+
+def from_environment(slots):
+    path = os.environ.get("SESSION_STORE_PATH")
+    if path is None:
+        path = data_path("sessions.sqlite")
+    return SessionStore(
+        path,
+        slots,
+        cache_size=int(os.environ.get("SESSION_CACHE_SIZE", 4096)),
+    )
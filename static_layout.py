@@ -0,0 +1,65 @@
+"""Serve the Dash layout as a precomputed, pre-compressed JSON blob.
+
+Dash walks and serialises the whole component tree on every request to
+/_dash-layout. The layout only changes with the framework, so it is
+serialised once, compressed once per encoding and served with a strong ETag.
+Each encoding's body is a different representation, so each gets its own ETag.
+"""
+import gzip
+import hashlib
+import json
+
+import dash
+import flask
+import plotly
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class FrozenLayout:
+    def __init__(self, layout, version=""):
+        body = json.dumps(layout, cls=plotly.utils.PlotlyJSONEncoder).encode()
+        digest = hashlib.sha256(body).hexdigest()[:16]
+        etag = f"{version[:16]}-{digest}" if version else digest
+        self.bodies = {"identity": body, "gzip": gzip.compress(body, 9)}
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(body)
+        self.etags = {
+            encoding: etag if encoding == "identity" else f"{etag}-{encoding}"
+            for encoding in self.bodies
+        }
+
+    def encoding(self, request):
+        for encoding in ("br", "gzip"):
+            if encoding in self.bodies and encoding in request.accept_encodings:
+                return encoding
+        return "identity"
+
+    def response(self, request):
+        encoding = self.encoding(request)
+        if self.etags[encoding] in request.if_none_match:
+            response = flask.Response(status=304)
+        else:
+            response = flask.Response(
+                self.bodies[encoding], mimetype="application/json"
+            )
+            if encoding != "identity":
+                response.headers["Content-Encoding"] = encoding
+        response.set_etag(self.etags[encoding])
+        response.headers["Cache-Control"] = "no-cache"
+        response.vary.add("Accept-Encoding")
+        return response
+
+
+class StaticLayoutDash(dash.Dash):
+    """A Dash app that serves its frozen_layout, once one is set."""
+
+    frozen_layout = None
+
+    def serve_layout(self):
+        if self.frozen_layout is None:
+            return super().serve_layout()
+        return self.frozen_layout.response(flask.request)
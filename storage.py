@@ -0,0 +1,72 @@
+"""Where the app keeps its SQLite databases, and how each process uses them.
+
+Respondents' saved answers and the cohort counted from them live under
+DATA_DIR (ASSESSMENT_DATA_DIR, "data" by default). The framework cache
+(FRAMEWORK_CACHE_DIR) only holds snapshots rebuilt from the workbook and
+may be cleared at any time, so nothing durable is kept there.
+
+Several gunicorn workers, and several threads in each, share every
+database. Each thread gets its own connection in WAL mode, so readers never
+wait for the one writer.
+"""
+import os
+import sqlite3
+import threading
+
+DATA_DIR = os.environ.get("ASSESSMENT_DATA_DIR", "data")
+
+
+def data_path(name):
+    """The path of a file under DATA_DIR, creating the directory if needed."""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    return os.path.join(DATA_DIR, name)
+
+
+class Database:
+    def __init__(self, path, schema=()):
+        """schema is run on each new connection: SQL, or (SQL, parameters)."""
+        self.path = path
+        self.schema = schema
+        self.local = threading.local()
+
+    def connection(self):
+        """This thread's connection, opened on first use."""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            for statement in self.schema:
+                if isinstance(statement, str):
+                    statement = (statement,)
+                connection.execute(*statement)
+            self.local.connection = connection
+        return connection
+
+
+class PerProcess:
+    """A value made once in each process, on first use.
+
+    Threads do not survive a fork, so whatever runs them (a thread pool, a
+    watching thread) is made again in each gunicorn worker.
+    """
+
+    def __init__(self, make):
+        self.make = make
+        self.lock = threading.Lock()
+        self.pid = None
+        self.value = None
+        # The lock may have been held by another thread when the process forked.
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self.lock = threading.Lock()
+
+    def get(self):
+        if self.pid == os.getpid():
+            return self.value
+        with self.lock:
+            if self.pid != os.getpid():
+                self.value = self.make()
+                self.pid = os.getpid()
+            return self.value
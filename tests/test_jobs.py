@@ -0,0 +1,66 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import jobs
+from jobs import JobQueue
+
+KEY = "report"
+
+
+class SharedJobTest(unittest.TestCase):
+    """One report job waited for by two respondents with the same answers."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.queue = JobQueue(os.path.join(directory.name, "jobs.sqlite"))
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def build(self, job):
+        while not self.release.wait(0.005):
+            job.progress(0.5)
+        return "report"
+
+    def state(self, subscriber=None):
+        return self.queue.status(KEY, subscriber)["state"]
+
+    def wait_for(self, state):
+        deadline = time.monotonic() + 5
+        while self.state() != state and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.assertEqual(self.state(), state)
+
+    def test_cancelling_detaches_only_the_caller(self):
+        self.queue.submit(KEY, self.build, subscriber="first")
+        self.queue.submit(KEY, self.build, subscriber="second")
+        self.wait_for(jobs.RUNNING)
+
+        self.assertFalse(self.queue.cancel(KEY, subscriber="first"))
+        self.assertEqual(self.state("first"), jobs.CANCELLED)
+        self.assertEqual(self.state("second"), jobs.RUNNING)
+
+        self.release.set()
+        self.wait_for(jobs.DONE)
+        self.assertEqual(self.queue.status(KEY, "second")["result"], "report")
+
+    def test_last_subscriber_cancels_the_job(self):
+        self.queue.submit(KEY, self.build, subscriber="first")
+        self.queue.submit(KEY, self.build, subscriber="second")
+        self.queue.cancel(KEY, subscriber="first")
+        self.assertTrue(self.queue.cancel(KEY, subscriber="second"))
+        self.assertEqual(self.state(), jobs.CANCELLED)
+
+    def test_resubmitting_after_cancelling_waits_again(self):
+        self.queue.submit(KEY, self.build, subscriber="first")
+        self.queue.submit(KEY, self.build, subscriber="second")
+        self.queue.cancel(KEY, subscriber="first")
+        self.queue.submit(KEY, self.build, subscriber="first")
+        self.assertIn(self.state("first"), (jobs.QUEUED, jobs.RUNNING))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import random
+import unittest
+
+import numpy as np
+
+from framework import load_framework
+from scoring import UNANSWERED, ScoringModel, ScoringState, ScoringStates
+
+
+def setUpModule():
+    global model
+    model = ScoringModel(load_framework())
+
+
+class CheckedChangesTest(unittest.TestCase):
+    """Answer deltas come from the browser, so each pair is checked."""
+
+    def test_answers_and_blanks_are_accepted(self):
+        value = max(model.answer_values[0])
+        changes = [[0, value], [1, None], [len(model.ids) - 1, UNANSWERED]]
+        self.assertEqual(
+            model.checked_changes(changes),
+            [(0, value), (1, UNANSWERED), (len(model.ids) - 1, UNANSWERED)],
+        )
+
+    def test_unknown_slots_are_rejected(self):
+        for slot in [len(model.ids), -1, "0", 0.0, True, None]:
+            with self.assertRaises(ValueError):
+                model.checked_changes([[slot, UNANSWERED]])
+
+    def test_values_outside_the_answer_options_are_rejected(self):
+        for value in [1000, max(model.answer_values[0]) + 1, "1", 1.0, -2]:
+            with self.assertRaises(ValueError):
+                model.checked_changes([[0, value]])
+
+    def test_malformed_changes_are_rejected(self):
+        for changes in [[[0]], [[0, 1, 2]], [0], None, 5]:
+            with self.assertRaises(ValueError):
+                model.checked_changes(changes)
+
+
+class ScoringStateTest(unittest.TestCase):
+    """Live scores, updated one answer at a time, against a full rescoring."""
+
+    def setUp(self):
+        self.rng = random.Random(0)
+
+    def random_change(self):
+        slot = self.rng.randrange(len(model.ids))
+        return slot, self.rng.choice([UNANSWERED, *model.answer_values[slot]])
+
+    def assertScoresMatch(self, state, encoded):
+        combined = model.reduce(model.decode_answers(encoded))["combined"]
+        live = np.array([state.combined[issue] for issue in model.combined_issues])
+        for column, name in enumerate(["Score", "combined_score", "priority_score"]):
+            np.testing.assert_allclose(live[:, column], combined[name][0], err_msg=name)
+
+    def test_apply_matches_full_rescoring(self):
+        state = ScoringState(model)
+        encoded = np.full(len(model.ids), UNANSWERED)
+        for _ in range(500):
+            slot, value = self.random_change()
+            state.apply(slot, value)
+            encoded[slot] = value
+            self.assertScoresMatch(state, encoded)
+
+    def test_states_follow_answers_saved_elsewhere(self):
+        # Two tabs answer the same session; each update sees only the saved
+        # answers, which include the other tab's changes.
+        states = ScoringStates(model)
+        encoded = np.full(len(model.ids), UNANSWERED)
+        for _ in range(200):
+            for _ in range(self.rng.randrange(1, 4)):
+                slot, value = self.random_change()
+                encoded[slot] = value
+            self.assertScoresMatch(states.update("session", encoded), encoded)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from scoring import UNANSWERED
+from sessions import SessionStore
+
+SLOTS = [f"{reference}-Business" for reference in range(1, 41)]
+SESSION = "0" * 32
+
+
+class SharedSessionTest(unittest.TestCase):
+    """Two stores on one database, as two gunicorn workers would have."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "sessions.sqlite")
+        self.first = SessionStore(self.path, SLOTS)
+        self.second = SessionStore(self.path, SLOTS)
+
+    def test_changes_from_both_workers_are_kept(self):
+        self.first.apply(SESSION, [(0, 3)])
+        self.second.apply(SESSION, [(1, 2)])
+        for store in [self.first, self.second, SessionStore(self.path, SLOTS)]:
+            answers = store.answers(SESSION)
+            self.assertEqual(answers[:3].tolist(), [3, 2, UNANSWERED])
+
+    def test_cached_answers_see_other_workers_changes(self):
+        self.first.apply(SESSION, [(0, 1)])
+        self.assertEqual(self.first.answers(SESSION)[0], 1)
+        self.second.apply(SESSION, [(0, 4)])
+        self.assertEqual(self.first.answers(SESSION)[0], 4)
+        self.second.apply(SESSION, [(0, None)])
+        self.assertEqual(self.first.answers(SESSION)[0], UNANSWERED)
+
+    def test_concurrent_changes_are_all_kept(self):
+        def answer(store, slots):
+            for slot in slots:
+                store.apply(SESSION, [(slot, slot % 5)])
+
+        threads = [
+            threading.Thread(
+                target=answer,
+                args=([self.first, self.second][thread % 2], range(thread, 40, 8)),
+            )
+            for thread in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        expected = [slot % 5 for slot in range(40)]
+        self.assertEqual(self.first.answers(SESSION).tolist(), expected)
+        self.assertEqual(self.second.answers(SESSION).tolist(), expected)
+
+    def test_answers_carry_over_to_new_slots(self):
+        self.first.apply(SESSION, [(0, 3), (1, 2)])
+        moved = SessionStore(self.path, SLOTS[1:] + ["99-Business"])
+        answers = moved.answers(SESSION)
+        self.assertEqual(answers[0], 2)
+        self.assertEqual(answers[-1], UNANSWERED)
+        moved.apply(SESSION, [(len(SLOTS) - 1, 1)])
+        self.assertEqual(moved.answers(SESSION)[[0, -1]].tolist(), [2, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
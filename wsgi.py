@@ -0,0 +1,18 @@
+"""WSGI entry point for production servers.
+
+    gunicorn --config gunicorn.conf.py wsgi:server
+
+Importing this module loads the framework, the country risk store and the
+frozen layout. With gunicorn's preload_app that happens once in the master,
+and the forked workers share those pages copy-on-write.
+"""
+import gc
+
+from assessment_tool import app
+
+server = app.server
+
+# Everything loaded so far lives as long as the process. Moving it out of the
+# collector's generations stops collections in the workers from touching (and
+# so copying) the shared pages.
+gc.freeze()